@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
-import os, sys, time, struct
+import os, sys, time, struct, json, csv, select, re
+import gzip, lzma, threading, bisect, queue, hashlib, sqlite3
+from collections import deque
 import serial
 import serial.tools.list_ports
 import argparse
@@ -802,16 +804,179 @@ class TransportError(Exception):
         return self.message
 
 
+TRACE_MAGIC = b'HC32TRC\x01'
+TRACE_REC = struct.Struct('<cIH') # 类型W/R/B, 距上条记录的微秒数, 数据长度
+
+class TraceWriter():
+    """Compact binary wire trace: magic, <I header length, JSON header, then
+    records of TRACE_REC followed by the data bytes
+    """
+    def __init__(self, path, header):
+        self.fp = open(path, "wb")
+        hdr = json.dumps(header).encode()
+        self.fp.write(TRACE_MAGIC + struct.pack('<I', len(hdr)) + hdr)
+        self.last = time.monotonic()
+
+    def record(self, kind, dat):
+        now = time.monotonic()
+        dt, self.last = int((now-self.last)*1e6), now
+        for ofs in range(0, len(dat), 0xFFFF):
+            self.fp.write(TRACE_REC.pack(kind, min(dt, 0xFFFFFFFF), len(dat[ofs:ofs+0xFFFF])))
+            self.fp.write(dat[ofs:ofs+0xFFFF])
+            dt = 0
+
+    def flush(self):
+        self.fp.flush()
+
+def load_trace(path):
+    # 返回(header, [(kind, t秒, data)])，t为距离首条记录的绝对时间
+    with open(path, "rb") as fp:
+        raw = fp.read()
+    if raw[:8] != TRACE_MAGIC:
+        raise ValueError("%s: not a hc32flash trace" % path)
+    n = struct.unpack_from('<I', raw, 8)[0]
+    header = json.loads(raw[12:12+n].decode())
+    records, ofs, t = [], 12+n, 0
+    while ofs + TRACE_REC.size <= len(raw):
+        kind, dt, size = TRACE_REC.unpack_from(raw, ofs)
+        ofs += TRACE_REC.size
+        t += dt / 1e6
+        records.append((kind, t, raw[ofs:ofs+size]))
+        ofs += size
+    return header, records
+
+class TraceSerial():
+    """Serial wrapper recording written/read bytes and baud changes"""
+    def __init__(self, link, trace):
+        object.__setattr__(self, 'link', link)
+        object.__setattr__(self, 'trace', trace)
+
+    def __getattr__(self, name):
+        return getattr(self.link, name)
+
+    def __setattr__(self, name, value):
+        if name == 'baudrate':
+            self.trace.record(b'B', struct.pack('<I', value))
+        setattr(self.link, name, value)
+
+    def write(self, dat):
+        self.trace.record(b'W', dat)
+        return self.link.write(dat)
+
+    def read(self, size=1):
+        dat = self.link.read(size)
+        if dat: self.trace.record(b'R', dat)
+        return dat
+
+    def close(self):
+        self.trace.flush()
+        self.link.close()
+
+class ReplaySerial():
+    """Fake port answering from a trace: received bytes become readable the
+    recorded delay after the write that preceded them, writes are compared
+    """
+    def __init__(self, path):
+        self.header, records = load_trace(path)
+        self.port = self.header.get('port') or 'replay'
+        self.baudrate, self.timeout, self.write_timeout = 0, 1, None
+        self.rts = self.dtr = False
+        self.tx = []  # [(data, 录制时间)]
+        self.rx = []  # [(data, 前一条写入的序号, 相对该写入的延时)]
+        last = (-1, 0.0)
+        for kind, t, dat in records:
+            if kind == b'W':
+                self.tx.append((dat, t))
+                last = (len(self.tx)-1, t)
+            elif kind == b'R':
+                self.rx.append((dat, last[0], t-last[1]))
+        self.t_record = records and records[-1][1] or 0.0
+        self.t0 = time.monotonic()
+        self.sent = {-1: self.t0}
+        self.wi = self.wofs = self.ri = self.rofs = 0
+        self.writes = self.mismatch = 0
+        self.polled = -1 # 已由in_waiting报告的接收记录
+
+    def write(self, dat):
+        self.writes += 1
+        pos = 0
+        while pos < len(dat) and self.wi < len(self.tx):
+            exp = self.tx[self.wi][0]
+            n = min(len(dat)-pos, len(exp)-self.wofs)
+            if dat[pos:pos+n] != exp[self.wofs:self.wofs+n]:
+                self.mismatch += 1
+            pos, self.wofs = pos+n, self.wofs+n
+            if self.wofs == len(exp):
+                self.sent[self.wi] = time.monotonic()
+                self.wi, self.wofs = self.wi+1, 0
+        return len(dat)
+
+    def ready(self):
+        # 当前可读的时刻，对应写入尚未发生时为None；录制的R时刻晚于原轮询，
+        # 已被in_waiting报告过的记录在写入回放后立即可读
+        if self.ri >= len(self.rx):
+            return None
+        dat, wi, delay = self.rx[self.ri]
+        if wi not in self.sent:
+            return None
+        return self.sent[wi] + (self.polled != self.ri and delay or 0)
+
+    @property
+    def in_waiting(self):
+        # 轮询不等录制延时：对应写入已回放即报告，避免轮询恰在释放前错过
+        if self.ri >= len(self.rx) or self.rx[self.ri][1] not in self.sent:
+            return 0
+        self.polled = self.ri
+        return len(self.rx[self.ri][0])-self.rofs
+
+    def read(self, size=1):
+        buf = b''
+        end = time.monotonic() + (self.timeout or 0)
+        while len(buf) < size:
+            t, now = self.ready(), time.monotonic()
+            if t is None or t > now:
+                wait = min(t is None and end or t, end) - now
+                if wait <= 0: break
+                time.sleep(min(wait, 0.01))
+                continue
+            dat = self.rx[self.ri][0]
+            n = min(size-len(buf), len(dat)-self.rofs)
+            buf += dat[self.rofs:self.rofs+n]
+            self.rofs += n
+            if self.rofs == len(dat):
+                self.ri, self.rofs = self.ri+1, 0
+        return buf
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def flush(self): pass
+    def flushInput(self): pass # 被清掉的字节未经read，不在trace中
+    def close(self): pass
+
+    def summary(self):
+        return dict(writes=self.writes, mismatch=self.mismatch,
+                    unsent=len(self.tx)-self.wi, unread=len(self.rx)-self.ri,
+                    recorded=round(self.t_record, 4), replayed=round(time.monotonic()-self.t0, 4))
+
 class SerialTransport():
-    def __init__(self, port, baud, dir1=False):
+    def __init__(self, port, baud, dir1=False, lean=False, link=None, half_duplex=False):
         if not port:
             _ports = serial.tools.list_ports.comports()
             if len(_ports):
                 port = _ports[-1].device
         self.serial = None
+        # rfc2217://host:port 或 socket://host:port 走网络串口服务器
+        self.network = '://' in port
         try:
-            self.serial = serial.Serial(port, baud)
-        except serial.SerialException as e:
+            if link is not None: # 已打开的端口，如trace回放
+                self.serial = link
+                link.baudrate = baud
+            elif self.network:
+                self.serial = serial.serial_for_url(port, baud)
+            else:
+                self.serial = serial.Serial(port, baud)
+        except (serial.SerialException, ValueError) as e:
             raise TransportError(str(e)) from None
 
         self.SET = dir1
@@ -823,35 +988,126 @@ class SerialTransport():
         self.serial.dtr = self.RESET
         self.serial.timeout = 1
         self.serial.write_timeout = None
+        # lean模式下不做逐包的输入检查和tcdrain，仅在应答异常时清空输入
+        self.lean = lean
+        self.stats = dict.fromkeys(('write', 'read', 'drain', 'poll', 'purge'), 0)
+        # 各操作的基础超时(秒)，实际读超时再加上请求与应答的线上传输时间
+        self.timeouts = {'cmd': 1.0, 'erase': 1.0, 'write': 0.2, 'read': 0.2, 'verify': 1.0, 'page': 0.5}
+        self.latency_restore = None
+        self.pending_ack = 0
+        # 单线半双工(TOOL0)：发出的每个字节都会回显，读应答前逐字节核对后丢弃
+        self.half_duplex = half_duplex
+        self.echo = bytearray()
+        self.echo_errors = 0
 
     def init_baud(self, baud):
         self.serial.baudrate = baud
 
-    def write(self, data, flush=True):
-        if self.serial.inWaiting() > 0:
-            self.serial.flushInput()
+    def deadline(self, kind, nbytes=0, extra=0):
+        t = self.timeouts[kind] + extra + nbytes * 10.0 / self.serial.baudrate
+        if t != self.serial.timeout: # 修改timeout会重新配置串口，仅在变化时设置
+            self.serial.timeout = t
+
+    def set_latency_timer(self, ms, root='/sys/bus/usb-serial/devices'):
+        tty = os.path.basename(os.path.realpath(self.serial.port))
+        path = os.path.join(root, tty, 'latency_timer')
+        try:
+            with open(path, "r") as fp:
+                old = fp.read().strip()
+            with open(path, "w") as fp:
+                fp.write('%d\n' % ms)
+        except OSError:
+            return False
+        if self.latency_restore is None:
+            self.latency_restore = (path, old)
+        return True
+
+    def write(self, data, flush=True, echo=True):
+        if self.pending_ack:
+            self.drain_pending()
+        if self.half_duplex:
+            # 回显已核对发送完成，无需输入检查和tcdrain
+            self.filter_echo()
+            self.stats['write'] += 1
+            cnt = self.serial.write(data)
+            if echo: self.echo += data
+            return cnt
+        if not self.lean:
+            self.stats['poll'] += 1
+            if self.serial.inWaiting() > 0:
+                self.purge()
+        self.stats['write'] += 1
         cnt = self.serial.write(data)
-        if flush: self.serial.flush()
+        if flush and not self.lean:
+            self.stats['drain'] += 1
+            self.serial.flush()
         return cnt
 
     def read(self, length):
+        if self.echo and not self.filter_echo():
+            return b''
+        self.stats['read'] += 1
         return self.serial.read(length)
 
+    def filter_echo(self):
+        # 回显与发送不一致即线上冲突，清空输入，本次应答作废
+        if not self.echo:
+            return True
+        self.stats['read'] += 1
+        dat = self.serial.read(len(self.echo))
+        ok = dat == self.echo
+        self.echo = bytearray()
+        if not ok:
+            self.echo_errors += 1
+            self.purge()
+        return ok
+
+    def read_available(self):
+        if not self.serial.in_waiting:
+            return b''
+        if not self.network:
+            return self.read(self.serial.in_waiting)
+        # socket://的in_waiting只表示可读，并非字节数
+        timeout, self.serial.timeout = self.serial.timeout, 0
+        dat = self.read(65536)
+        self.serial.timeout = timeout
+        return dat
+
+    def purge(self):
+        self.stats['purge'] += 1
+        self.echo = bytearray()
+        self.serial.flushInput()
+
+    def expect(self, ack, length):
+        dat = self.read(length)
+        if dat != ack and self.lean:
+            self.purge()
+        return dat == ack
+
     def close(self):
         self.serial.flush()
         self.serial.close()
+        if self.latency_restore:
+            path, old = self.latency_restore
+            try:
+                with open(path, "w") as fp:
+                    fp.write('%s\n' % old)
+            except OSError:
+                pass
+            self.latency_restore = None
 
     def goto_bootloader(self):
         self.serial.rts = self.RESET
         self.serial.dtr = self.RESET
         time.sleep(0.5)
-        self.write(b'\x18\xFF'*100, flush=False)
+        self.write(b'\x18\xFF'*100, flush=False, echo=False)
         self.serial.rts = self.SET
         self.serial.dtr = self.SET
-        self.write(b'\x18\xFF'*10, flush=False)
+        self.write(b'\x18\xFF'*10, flush=False, echo=False)
         time.sleep(0.5)
         if self.serial.in_waiting:
-            ack = self.read(self.serial.in_waiting)
+            ack = self.read_available()
+            self.detect_echo(ack)
             if ack[-3:] == b'\x11'*3:
                 time.sleep(2) # clear input buffer
                 self.serial.flushInput()
@@ -860,16 +1116,23 @@ class SerialTransport():
 
     def wait_bootloader(self):
         for x in range(10):
-            self.write(b'\x18\xFF'*50, flush=False)
+            self.write(b'\x18\xFF'*50, flush=False, echo=False)
             time.sleep(0.1)
             if self.serial.in_waiting:
-                ack = self.read(self.serial.in_waiting)
+                ack = self.read_available()
+                self.detect_echo(ack)
                 if ack[-3:] == b'\x11'*3:
                     self.serial.flushInput()
                     return True
         return False
 
+    def detect_echo(self, ack):
+        # 握手数据原样读回说明是单线连接
+        if not self.half_duplex and ack[:4] == b'\x18\xFF\x18\xFF':
+            self.half_duplex = True
+
     def check_lock(self):
+        self.deadline('cmd')
         self.write(b'\x01\xFC\x0B\x00\x00\x02\x00\x00\x00\x0A')
         ack = self.read(5)
         if len(ack)==5 and ack[:2]==b'\x01\x02':
@@ -880,67 +1143,163 @@ class SerialTransport():
         self.write(b'\xB5\x34\x84\x52\xBF')
         return self.read(1) == b'\x01'
 
-    def load_ramcode(self, _f, tryCnt=50):
-        with open(_f, "rb") as fr:
-            dat = fr.read()
-            fr.close()
-            size = len(dat)
-            addr = 0x20000000
-            pkg = struct.pack('<b2I',0,addr,size)
-            chksum = bytes([sum(pkg)&0xFF])
-            self.write(pkg+chksum)
-            if self.read(1) == b'\x01':
-                cnt = self.write(dat + bytes([sum(dat)&0xFF]))
-                while self.read(1) != b'\x01' and tryCnt > 0:
-                    time.sleep(0.1)
-                    tryCnt -= 1
-                return tryCnt > 0
+    def load_ramcode(self, dat, tryCnt=50):
+        size = len(dat)
+        addr = 0x20000000
+        pkg = struct.pack('<b2I',0,addr,size)
+        chksum = bytes([sum(pkg)&0xFF])
+        self.write(pkg+chksum)
+        if self.read(1) == b'\x01':
+            cnt = self.write(dat + bytes([sum(dat)&0xFF]))
+            while self.read(1) != b'\x01' and tryCnt > 0:
+                time.sleep(0.1)
+                tryCnt -= 1
+            return tryCnt > 0
         return False
 
     def run_ramcode(self):
         self.write(b'\xC0\x00\x00\x00\x00\x00\x00\x00\x00\xC0')
         return repr(self.read(11))
 
-    def ramcode_api(self, cmd, addr, dat, size=0):
+    @staticmethod
+    def ramcode_api(cmd, addr, dat, size=0):
         size = size or len(dat)
         pkg = bytes([0x49,cmd]) + struct.pack('<IH',addr,size) + dat
         return pkg + bytes([sum(pkg)&0xFF])
 
     def set_baud(self, baud):
+        self.deadline('cmd', 13+9)
         self.write(self.ramcode_api(0x01, 0, struct.pack('<I',baud)))
         ack = self.ramcode_api(0x00, 0, b'')
-        return self.read(9) == ack
+        return self.expect(ack, 9)
 
-    def flash_erase(self):
-        self.write(self.ramcode_api(0x02,0,b''))
+    def flash_erase(self, progress=None, poll=0.25):
+        # 分段轮询应答直到截止时间，超时后记下未收到的字节，避免迟到的应答被下一条命令读到
         ack = self.ramcode_api(0x00, 0, b'')
-        return self.read(9) == ack
+        self.write(self.ramcode_api(0x02,0,b''))
+        t0 = time.time()
+        total = self.timeouts['erase'] + 18 * 10.0 / self.serial.baudrate
+        dat = b''
+        while len(dat) < 9:
+            left = total - (time.time()-t0)
+            if left <= 0: break
+            self.serial.timeout = min(poll, left)
+            dat += self.read(9-len(dat))
+            if progress and len(dat) < 9:
+                progress(time.time()-t0, total)
+        if len(dat) < 9:
+            self.pending_ack = 9-len(dat)
+            return False
+        if dat != ack and self.lean:
+            self.purge()
+        return dat == ack
+
+    def flash_erase_page(self, addr):
+        self.deadline('page', 18)
+        self.write(self.ramcode_api(0x03, addr, b''))
+        return self.expect(self.ramcode_api(0x00, addr, b''), 9)
 
-    def flash_write(self, addr, dat):
-        self.write(self.ramcode_api(0x04, addr, dat))
+    def drain_pending(self):
+        # 丢弃上一次超时命令的迟到应答，设备仍在擦除，最多再等一个擦除超时
+        if self.pending_ack:
+            self.serial.timeout = self.timeouts['erase']
+            self.read(self.pending_ack)
+            self.pending_ack = 0
+            self.purge()
+
+    def flash_write(self, addr, dat, frame=None):
+        frame = frame or self.ramcode_api(0x04, addr, dat)
+        # 扇区擦除帧(0x03)也可混在写入序列中，按擦除时间给超时
+        self.deadline(frame[1] == 0x03 and 'page' or 'write', len(frame)+9)
+        self.write(frame)
         ack = self.ramcode_api(0x00, addr, b'')
-        self.serial.flush()
-        return self.read(9) == ack
+        if not self.lean and not self.half_duplex:
+            self.stats['drain'] += 1
+            self.serial.flush()
+        return self.expect(ack, 9)
+
+    def flash_write_pipelined(self, frames, window=1):
+        # 连续发送最多window帧后再依次读取应答，隐藏网络往返延迟
+        self.drain_pending()
+        pending = deque()
+        frames = iter(frames)
+        flen = 0
+        while True:
+            while len(pending) < window:
+                item = next(frames, None)
+                if item is None: break
+                addr, frame = item
+                flen = max(flen, len(frame))
+                if frame[1] == 0x03: # 流水线中有擦除帧时放宽到擦除超时
+                    self.deadline('page', window*(flen+9))
+                elif not pending:
+                    self.deadline('write', window*(len(frame)+9))
+                # 不能清空输入，前面帧的应答可能已经到达
+                self.stats['write'] += 1
+                self.serial.write(frame)
+                pending.append(addr)
+            if not pending:
+                return
+            addr = pending.popleft()
+            ok = self.read(9) == self.ramcode_api(0x00, addr, b'')
+            if not ok: self.purge()
+            yield addr, ok
+            if not ok:
+                return
 
     def flash_read(self, addr, size):
         dat = None; psize = 9+size
+        self.deadline('read', 9+psize)
         self.write(self.ramcode_api(0x05, addr, b'', size))
         ack = self.read(psize)
         if len(ack)==(psize) and (sum(ack[:-1])&0xFF)==ack[-1]:
             dat = ack[8:8+size]
+        elif self.lean:
+            self.purge()
         return dat
 
+    def flash_read_pipelined(self, addrs, size, window=1):
+        self.drain_pending()
+        pending = deque()
+        addrs = iter(addrs)
+        psize = 9+size
+        while True:
+            while len(pending) < window:
+                addr = next(addrs, None)
+                if addr is None: break
+                if not pending:
+                    self.deadline('read', window*(9+psize))
+                self.stats['write'] += 1
+                self.serial.write(self.ramcode_api(0x05, addr, b'', size))
+                pending.append(addr)
+            if not pending:
+                return
+            addr = pending.popleft()
+            ack = self.read(psize)
+            dat = None
+            if len(ack)==(psize) and (sum(ack[:-1])&0xFF)==ack[-1]:
+                dat = ack[8:8+size]
+            else:
+                self.purge()
+            yield addr, dat
+            if dat is None:
+                return
+
     def flash_verify(self, size):
+        self.deadline('verify', 13+11, size/1e6) # ramcode累加约1MB/s
         self.write(self.ramcode_api(0x06, 0, struct.pack('<I',size)))
         ack = self.read(11)
         if len(ack)==11 and (sum(ack[:-1])&0xFF)==ack[-1]:
             return ack[8:10]
+        elif self.lean:
+            self.purge()
         return None
 
     def flash_lock(self):
+        self.deadline('cmd', 9+9)
         self.write(self.ramcode_api(0x09, 0, b''))
         ack = self.ramcode_api(0x00, 0, b'')
-        return self.read(9) == ack
+        return self.expect(ack, 9)
 
     def reboot(self):
         self.serial.rts = self.RESET
@@ -978,212 +1337,1907 @@ def find_device_simple(input_device, hdsc_keys):
 
     return candidates[best_match] if best_match else candidates[matches[0]]
 
-if __name__ == '__main__':
-    # parse arguments or use defaults
-    parser = argparse.ArgumentParser(description='HC32xx Flash Downloader.')
-    parser.add_argument('-l', '--list', action='store_true', help='List support device')
-    parser.add_argument('-d', metavar=' device', default='HC32F003', help='Device name, default HC32F003')
-    parser.add_argument('-p', metavar=' port', default='', help='Serial port, default serial[-1]')
-    parser.add_argument('-b', metavar=' baudrate',type=int,default=0, help='Serial baudrate')
-    parser.add_argument('-u', '--unlock', action='store_true', help='Unlock. Erase device when locked')
-    parser.add_argument('-L', '--lock', action='store_true', help='Lock. SWD port disabled')
-    parser.add_argument('-R', '--reboot', action='store_true', help='Reboot device')
-    parser.add_argument('-e', '--erase', action='store_true', help='Erase device')
-    parser.add_argument('-G', '--goboot', action='store_true', help='Goto bootloader')
-    parser.add_argument('-D', '--dir1', action='store_true', help='RTS/DTR output 1 for reset')
-    parser.add_argument('-w', metavar='<filename>', help='Write data from file to device')
-    parser.add_argument('-r', metavar='<filename>', help='Read data from device to file')
-    parser.add_argument('-v', metavar='<filename>', help='Verify chksum data in device against file')
-    args = parser.parse_args()
+def parse_image_spec(spec):
+    # "app.bin@0x8000" -> ('app.bin', 0x8000)，未指定地址时为None
+    path, sep, addr = spec.rpartition('@')
+    if sep:
+        try:
+            return path, int(addr, 0)
+        except ValueError:
+            pass
+    return spec, None
 
-    args.dev,args.port,args.baud = args.d,args.p,args.b
-    args.rfile,args.wfile,args.vfile = args.r,args.w,args.v
+STREAM_SUFFIXES = ('.gz', '.xz', '.zst')
 
-    # check device
-    matched_device = find_device_simple(args.dev, list(HDSC.keys()))
-    if not matched_device:
-        sys.stdout.write("Invalid Device name '%s'.\n\nList of support device:\n" % args.dev)
-        args.list = True
+class ImageError(Exception):
+    """Image could not be read or decompressed, retrying the unit is pointless
+    """
+
+def open_image(path):
+    # '-'为标准输入，.gz/.xz/.zst透明解压
+    if path == '-':
+        return sys.stdin.buffer
+    if path.endswith('.gz'):
+        return gzip.open(path, "rb")
+    if path.endswith('.xz'):
+        return lzma.open(path, "rb")
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImageError("%s: zstandard module required, pip install zstandard" % path)
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    return open(path, "rb")
+
+class ImageStream():
+    """Image decompressed/read by a producer thread, consumed packet by packet
+
+    Chunks are kept so a retried write replays them, size and sum accumulate
+    as they arrive and give the verify checksum without a second pass.
+    """
+    def __init__(self, fp, psize, limit):
+        self.fp, self.psize, self.limit = fp, psize, limit
+        self.chunks, self.size, self.sum = [], 0, 0
+        self.done, self.error = False, None
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.produce, daemon=True)
+        self.thread.start()
+
+    def produce(self):
+        try:
+            while True:
+                dat = self.fp.read(self.psize)
+                # 管道/解压流可能返回不足一包，凑满再交给写入
+                while dat and len(dat) < self.psize:
+                    more = self.fp.read(self.psize-len(dat))
+                    if not more: break
+                    dat += more
+                if not dat: break
+                if self.size+len(dat) > self.limit:
+                    raise ValueError("image larger than flash %d bytes" % self.limit)
+                with self.cond:
+                    self.chunks.append(dat)
+                    self.size += len(dat)
+                    self.sum += sum(dat)
+                    self.cond.notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            if self.fp is not sys.stdin.buffer:
+                self.fp.close()
+            with self.cond:
+                self.done = True
+                self.cond.notify()
+
+    def packets(self):
+        i = 0
+        while True:
+            with self.cond:
+                while i >= len(self.chunks) and not self.done:
+                    self.cond.wait()
+                if i >= len(self.chunks):
+                    if self.error is not None:
+                        raise ImageError("image: %s" % self.error)
+                    return
+                dat = self.chunks[i]
+            yield dat
+            i += 1
+
+def load_images(specs, hc32xx):
+    # 多个镜像按地址合并成一个从StartAddress开始的镜像，空隙填0xFF
+    addr0 = int(hc32xx['StartAddress'], 16)
+    flash = int(hc32xx['PageSize']) * int(hc32xx['PageCount'])
+    segments = []
+    for spec in specs:
+        path, addr = parse_image_spec(spec)
+        with open_image(path) as fs:
+            dat = fs.read()
+        addr = addr0 if addr is None else addr
+        if addr < addr0 or addr+len(dat) > addr0+flash:
+            raise ValueError("%s: 0x%08X-0x%08X out of flash 0x%08X-0x%08X" %
+                (path, addr, addr+len(dat), addr0, addr0+flash))
+        segments.append((addr, dat, path))
+    segments.sort(key=lambda x: x[0])
+    for (a0, d0, p0), (a1, d1, p1) in zip(segments, segments[1:]):
+        if a0+len(d0) > a1:
+            raise ValueError("%s overlaps %s at 0x%08X" % (p0, p1, a1))
+    end = max(a+len(d) for a, d, _ in segments) - addr0
+    image = bytearray(b'\xFF' * end)
+    for addr, dat, _ in segments:
+        image[addr-addr0:addr-addr0+len(dat)] = dat
+    return bytes(image), [(addr, len(dat), path) for addr, dat, path in segments]
+
+def changed_pages(old, new, pgsize):
+    # 两版镜像按页比较，较短的一方以0xFF补齐
+    size = max(len(old), len(new))
+    old, new = old + b'\xFF'*(size-len(old)), new + b'\xFF'*(size-len(new))
+    return [i for i in range((size+pgsize-1)//pgsize)
+            if old[i*pgsize:(i+1)*pgsize] != new[i*pgsize:(i+1)*pgsize]]
+
+def build_frames(dat, psize, addr0):
+    # 预先编码所有写入帧，空白包(全0xFF)记为None
+    frames = []
+    for ofs in range(0, len(dat), psize):
+        pkt = dat[ofs:ofs+psize]
+        pkt = pkt + b'\xFF'*(psize-len(pkt))
+        frame = None
+        if pkt.rstrip(b'\xFF') != b'':
+            frame = SerialTransport.ramcode_api(0x04, addr0+ofs, pkt)
+        frames.append((addr0+ofs, frame))
+    return frames
+
+def parse_inject(spec):
+    # "0x3F00:u32:{n}" / "0x3F10:hex:{mac}" / "0x3F20:SN{n:06d}"
+    addr, _, template = spec.partition(':')
+    kind, sep, rest = template.partition(':')
+    if sep and kind in ('hex', 'u8', 'u16', 'u32'):
+        return int(addr, 0), kind, rest
+    return int(addr, 0), 'str', template
+
+def render_inject(kind, template, fields):
+    text = template.format(**fields)
+    if kind == 'hex':
+        return bytes.fromhex(''.join(c for c in text if c not in ':- '))
+    if kind in ('u8', 'u16', 'u32'):
+        return struct.pack({'u8': '<B', 'u16': '<H', 'u32': '<I'}[kind], int(text, 0))
+    return text.encode()
+
+def prepare_unit(args, hc32xx):
+    # 仅重新编码被注入数据覆盖的写入帧，并增量修正校验和
+    unit = {'n': args.counter, 'values': [], 'frames': {},
+            'vsum': args.vsum, 'vlen': args.vdata is not None and len(args.vdata) or 0}
+    args.counter += 1
+    if not args.inject:
+        return unit
+    fields = {'n': unit['n'], 'unix': int(time.time())}
+    if args.csv_rows is not None:
+        if not args.csv_rows:
+            raise ValueError("csv rows exhausted")
+        fields.update(args.csv_rows.pop(0))
+    addr0 = int(hc32xx['StartAddress'], 16)
+    flash = int(hc32xx['PageSize']) * int(hc32xx['PageCount'])
+    psize, base = args.psize, args.wdata
+    patch = {}
+    for addr, kind, template in args.inject:
+        val = render_inject(kind, template, fields)
+        if addr < addr0 or addr+len(val) > addr0+flash:
+            raise ValueError("inject 0x%08X-0x%08X out of flash" % (addr, addr+len(val)))
+        unit['values'].append((addr, val))
+        for i, b in enumerate(val):
+            patch[addr-addr0+i] = b
+    for idx in sorted(set(o//psize for o in patch)):
+        pkt = bytearray(base[idx*psize:idx*psize+psize])
+        pkt += b'\xFF'*(psize-len(pkt))
+        for i in range(psize):
+            if idx*psize+i in patch:
+                pkt[i] = patch[idx*psize+i]
+        unit['frames'][idx] = (addr0+idx*psize, SerialTransport.ramcode_api(0x04, addr0+idx*psize, bytes(pkt)))
+    if args.vdata is base:
+        # 超出镜像部分按0xFF计入校验
+        vlen = max([len(base)] + [o+1 for o in patch])
+        vsum = args.vsum + 0xFF*(vlen-len(base))
+        for o, b in patch.items():
+            vsum += b - (base[o] if o < len(base) else 0xFF)
+        unit['vsum'], unit['vlen'] = vsum & 0xFFFF, vlen
+    return unit
+
+def log_unit(args, unit, err):
+    if not unit['values']:
+        return
+    stamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+    with open(args.inject_log, "a") as fp:
+        for addr, val in unit['values']:
+            fp.write("%s,%s,%d,0x%08X,%s,%s\n" % (stamp, args.port, unit['n'], addr, val.hex(), err or 'ok'))
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY, time REAL, device TEXT, port TEXT, adapter TEXT, image TEXT,
+    baud INTEGER, unit INTEGER, retries INTEGER, checksum INTEGER, sha256 TEXT,
+    locked INTEGER, result TEXT, elapsed REAL, timings TEXT);
+CREATE INDEX IF NOT EXISTS units_time ON units(time);
+CREATE INDEX IF NOT EXISTS units_image ON units(image, time);
+CREATE INDEX IF NOT EXISTS units_port ON units(port, time);
+CREATE INDEX IF NOT EXISTS units_adapter ON units(adapter, time);
+"""
+
+def open_db(path):
+    # WAL模式下多个端口进程可同时写入，写锁冲突时等待
+    db = sqlite3.connect(path, timeout=10)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.executescript(DB_SCHEMA)
+    return db
+
+def image_hash(args):
+    if args.wstream:
+        return hashlib.sha256(b''.join(args.wstream.chunks)).hexdigest()
+    if args.image_hash is None and args.wdata is not None:
+        args.image_hash = hashlib.sha256(args.wdata).hexdigest()
+    return args.image_hash
+
+def record_unit(args, out, err):
+    # 每台一条记录，一个事务；数据库不可用时仅告警，不影响烧录
+    if not args.db or args.replay:
+        return
+    f = out.fields
+    try:
+        if args.db_conn is None:
+            args.db_conn = open_db(args.db)
+        with args.db_conn:
+            args.db_conn.execute('INSERT INTO units (time, device, port, adapter, image, baud, unit, retries, '
+                'checksum, sha256, locked, result, elapsed, timings) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                (out.t0, args.dev, args.port, args.adapter, image_hash(args), args.baud, f.get('unit'),
+                 f.get('retries', 0), f.get('checksum'), f.get('sha256'), int(bool(f.get('locked'))),
+                 err or 'ok', round(time.time()-out.t0, 4), json.dumps(out.timings)))
+    except sqlite3.Error as e:
+        sys.stderr.write("db: %s\n" % e)
+
+DB_QUERIES = {
+    'units': ("SELECT datetime(time,'unixepoch','localtime'), device, port, adapter, substr(image,1,12), "
+              "baud, retries, result, elapsed FROM units %s ORDER BY time DESC LIMIT 100",
+              ('time', 'device', 'port', 'adapter', 'image', 'baud', 'retries', 'result', 'elapsed')),
+    'adapters': ("SELECT adapter, count(*), sum(result!='ok'), sum(retries), "
+                 "round(100.0*sum(retries>0)/count(*),2), round(avg(elapsed),2) FROM units %s "
+                 "GROUP BY adapter ORDER BY count(*) DESC",
+                 ('adapter', 'units', 'fails', 'retries', 'retry%', 'avg_s')),
+    'images': ("SELECT substr(image,1,12), count(*), sum(result!='ok'), count(DISTINCT port), "
+               "datetime(min(time),'unixepoch','localtime'), datetime(max(time),'unixepoch','localtime') "
+               "FROM units %s GROUP BY image ORDER BY max(time) DESC",
+               ('image', 'units', 'fails', 'ports', 'first', 'last')),
+    'daily': ("SELECT date(time,'unixepoch','localtime') d, count(*), sum(result='ok'), sum(result!='ok'), "
+              "round(100.0*sum(result='ok')/count(*),2), round(avg(elapsed),2) FROM units %s "
+              "GROUP BY d ORDER BY d DESC",
+              ('date', 'units', 'pass', 'fails', 'yield%', 'avg_s')),
+}
+
+def parse_day(text):
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(text, fmt))
+        except ValueError:
+            pass
+    raise ValueError("invalid date '%s'" % text)
+
+def query_db(args, hc32xx, out):
+    sql, cols = DB_QUERIES[args.query]
+    where, params = [], []
+    if args.since:
+        where.append('time >= ?'); params.append(parse_day(args.since))
+    if args.until:
+        where.append('time < ?'); params.append(parse_day(args.until))
+    if args.port:
+        where.append('port = ?'); params.append(args.port)
+    if args.wfile:
+        where.append('image = ?'); params.append(hashlib.sha256(load_images(args.wfile, hc32xx)[0]).hexdigest())
+    if not os.path.exists(args.db):
+        raise sqlite3.OperationalError("%s: no such database" % args.db)
+    db = open_db(args.db)
+    rows = db.execute(sql % (where and 'WHERE ' + ' AND '.join(where) or ''), params).fetchall()
+    db.close()
+    widths = [max([len(c)] + [len(str(r[i])) for r in rows]) for i, c in enumerate(cols)]
+    out.write('  '.join(c.ljust(w) for c, w in zip(cols, widths)) + '\n')
+    for r in rows:
+        out.write('  '.join(str(v).ljust(w) for v, w in zip(r, widths)) + '\n')
+        out.event('row', **dict(zip(cols, r)))
+    return 0
+
+class DumpArchive():
+    """Content-addressed page store for -r dumps: pages/<ab>/<sha256> holds
+    each distinct page once, units/<name>.json lists a palette of page hashes
+    and a run-length map of palette indices
+    """
+    def __init__(self, root, name=None, meta=None):
+        self.root, self.name, self.meta = root, name, meta or {}
+        self.hashes, self.new, self.size = [], 0, 0
+        if name is not None:
+            self.check_name(name)
+
+    @staticmethod
+    def check_name(name):
+        if not name or '/' in name or os.sep in name or name.startswith('.'):
+            raise ValueError("invalid unit name '%s'" % name)
+
+    def page_path(self, h):
+        return os.path.join(self.root, 'pages', h[:2], h)
+
+    def unit_path(self, name):
+        return os.path.join(self.root, 'units', name + '.json')
+
+    def write(self, dat):
+        h = hashlib.sha256(dat).hexdigest()
+        path = self.page_path(h)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 多个工位可能同时写入同一新页，临时文件按进程区分；内容相同，谁后替换都一样
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp, "wb") as fp:
+                fp.write(dat)
+            os.replace(tmp, path)
+            self.new += 1
+        self.hashes.append(h)
+        self.size += len(dat)
+        return len(dat)
+
+    def commit(self):
+        palette, runs = [], []
+        for h in self.hashes:
+            if h not in palette: palette.append(h)
+            i = palette.index(h)
+            if runs and runs[-1][0] == i:
+                runs[-1][1] += 1
+            else:
+                runs.append([i, 1])
+        unit = dict(self.meta, name=self.name, size=self.size, page_size=self.size//max(len(self.hashes), 1),
+                    palette=palette, runs=runs)
+        path = self.unit_path(self.name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, "w") as fp:
+            json.dump(unit, fp)
+        os.replace(tmp, path)
+        return unit
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def load(self, name):
+        with open(self.unit_path(name), "r") as fp:
+            unit = json.load(fp)
+        unit['hashes'] = [unit['palette'][i] for i, n in unit['runs'] for _ in range(n)]
+        return unit
+
+    def pages(self, ref):
+        # 单元名或镜像文件 -> (页哈希列表, 取页函数, 页大小)
+        if os.path.exists(self.unit_path(ref)):
+            unit = self.load(ref)
+            return unit['hashes'], lambda i: self.read_page(unit['hashes'][i]), unit['page_size']
+        if not os.path.exists(ref):
+            raise ValueError("%s: no such unit or image" % ref)
+        with open_image(ref) as fp:
+            dat = fp.read()
+        return dat, None, None
+
+    def read_page(self, h):
+        with open(self.page_path(h), "rb") as fp:
+            return fp.read()
+
+    def extract(self, name, path):
+        unit = self.load(name)
+        cache = {}
+        with open(path, "wb") as fp:
+            for h in unit['hashes']:
+                if h not in cache: cache[h] = self.read_page(h)
+                fp.write(cache[h])
+        return unit
+
+    def diff(self, a, b):
+        # 返回[(页号, 页大小, 页a, 页b)]，镜像文件按单元的页大小切分并以0xFF补齐
+        pa, ga, sa = self.pages(a)
+        pb, gb, sb = self.pages(b)
+        psize = sa or sb
+        if psize is None:
+            raise ValueError("one side of --diff must be an archived unit")
+        if sa and sb and sa != sb:
+            raise ValueError("page size differs: %d/%d" % (sa, sb))
+        def split(dat, n):
+            dat = dat + b'\xFF' * (n*psize - len(dat))
+            pages = [dat[i*psize:(i+1)*psize] for i in range(n)]
+            return [hashlib.sha256(p).hexdigest() for p in pages], lambda i: pages[i]
+        n = max(len(pa) if sa else -(-len(pa)//psize), len(pb) if sb else -(-len(pb)//psize))
+        if not sa: pa, ga = split(pa, n)
+        if not sb: pb, gb = split(pb, n)
+        blank = hashlib.sha256(b'\xFF'*psize).hexdigest()
+        pa, pb = pa + [blank]*(n-len(pa)), pb + [blank]*(n-len(pb))
+        get = lambda g, p, i: i < len(p) and p[i] != blank and g(i) or b'\xFF'*psize
+        return psize, [(i, get(ga, pa, i), get(gb, pb, i)) for i in range(n) if pa[i] != pb[i]]
+
+def archive_diff(args, hc32xx, out):
+    archive = DumpArchive(args.archive)
+    a, b = args.diff
+    psize, pages = archive.diff(a, b)
+    addr0 = int(hc32xx['StartAddress'], 16)
+    out.write("[  DIFF] %s / %s: %d pages differ\n" % (a, b, len(pages)))
+    for i, da, db in pages:
+        idx = [k for k in range(psize) if da[k] != db[k]]
+        addr = addr0 + i*psize
+        out.write("  0x%08X-0x%08X %4d bytes, first 0x%08X: 0x%02X/0x%02X\n" %
+            (addr, addr+psize, len(idx), addr+idx[0], da[idx[0]], db[idx[0]]))
+        out.event('diff', addr='0x%08X' % addr, bytes=len(idx), first='0x%08X' % (addr+idx[0]))
+    return pages and 1 or 0
+
+def blank_check(transport, hc32xx, samples=8):
+    # 整片累加和等于全0xFF时再抽样读取确认；不等则一定非空白
+    addr0 = int(hc32xx['StartAddress'], 16)
+    pgsize, pcnt = int(hc32xx['PageSize']), int(hc32xx['PageCount'])
+    flash = pgsize * pcnt
+    ack = transport.flash_verify(flash)
+    if not ack or struct.unpack('<H', ack)[0] != (0xFF*flash) & 0xFFFF:
+        return False
+    size = min(pgsize, 512)
+    for i in range(samples):
+        addr = addr0 + (flash-size) * i // max(samples-1, 1)
+        dat = transport.flash_read(addr, size)
+        if dat is None or dat != b'\xFF'*size:
+            return False
+    return True
+
+def adapter_id(port):
+    # USB串口按 VID:PID:序列号 区分，其他串口直接用端口名
+    for p in serial.tools.list_ports.comports():
+        if p.device == port and p.vid is not None:
+            return '%04X:%04X:%s' % (p.vid, p.pid, p.serial_number or '')
+    return port
+
+def load_profile(path):
+    try:
+        with open(path, "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+def save_profile(path, profile):
+    tmp = path + '.tmp'
+    with open(tmp, "w") as fp:
+        json.dump(profile, fp, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+def profile_key(args):
+    return '%s|%s|%d' % (args.dev, args.adapter, args.baud)
+
+def save_erase_time(args, elapsed):
+    # 记下实测整片擦除耗时，供--sector-erase对比；变化不足10%不改写配置
+    profile = load_profile(args.profile)
+    entry = profile.setdefault(profile_key(args), {})
+    if abs(entry.get('EraseTime', 0) - elapsed) > 0.1 * elapsed:
+        entry['EraseTime'] = round(elapsed, 3)
+        save_profile(args.profile, profile)
+
+def packet_candidates(psize):
+    # ramcode缓冲区即为WritePacketSize上限，超出会溢出其RAM，只按16字节对齐向下取候选值
+    return sorted(set([max(16, psize*k//8//16*16) for k in (1,2,4)] + [psize]))
+
+def autotune_packet(args, transport, hc32xx, out):
+    psize = int(hc32xx['WritePacketSize'])
+    addr0 = int(hc32xx['StartAddress'], 16)
+    flash = int(hc32xx['PageSize']) * int(hc32xx['PageCount'])
+    sizes = packet_candidates(psize)
+    total = min(max(psize*8, 4096), flash)
+    out.write("[ TUNE ] ")
+    out.flush()
+    if not transport.flash_erase():
+        out.write("erase error\n")
+        return None
+    # 擦除后写0xFF不改变FLASH内容，结束后由正常流程再擦除一次
+    # 某一尺寸失败后不再尝试更大的包
+    best, rate = None, 0
+    for size in sizes:
+        t0 = time.time()
+        for ofs in range(0, total//size*size, size):
+            if not transport.flash_write(addr0+ofs, b'\xFF'*size):
+                break
+        else:
+            r = (total//size*size) / max(time.time()-t0, 1e-6)
+            out.write("%d:%.1fKB/s " % (size, r/1024))
+            if r > rate:
+                best, rate = size, r
+            out.flush()
+            continue
+        out.write("%d:error " % size)
+        transport.purge()
+        break
+    out.event('tune', sizes=sizes, best=best, rate=round(rate))
+    if best:
+        out.write("-> %d\n" % best)
+        profile = load_profile(args.profile)
+        profile.setdefault(profile_key(args), {}).update(
+            {'WritePacketSize': best, 'WriteRate': round(rate)})
+        save_profile(args.profile, profile)
     else:
-        args.dev = matched_device
+        out.write("error\n")
+    return best
 
-    if args.list:
-        for dev in HDSC.keys():
-            sys.stdout.write("%-28s %-8s %s\n" % (dev, HDSC[dev]['FlashSize'], HDSC[dev]['BootloaderBaudrate']))
-        sys.exit(0)
+# 估算模型参数：8N1每字节10位，按字编程耗时
+PLAN_BITS_PER_BYTE = 10
+PLAN_PROGRAM_US_PER_WORD = 30
+PLAN_LATENCY = 0.005
 
-    # mcu info
-    hc32xx =  HDSC[args.dev]
-    args.baud = args.baud or hc32xx['BootloaderBaudrate']
-    transport = SerialTransport(args.port, hc32xx['BootloaderBaudrate'], dir1=args.dir1)
-    sys.stdout.write('Device:     %s\n' % args.dev)
-    sys.stdout.write('Serial:     %s\n' % transport.serial.port)
-    sys.stdout.write('Boot Baud:  %s\n' % args.baud)
-    sys.stdout.write('Page Size:  %s\n' % hc32xx['PageSize'])
-    sys.stdout.write('Page Count: %s\n' % hc32xx['PageCount'])
-    sys.stdout.write('Flash Size: %s\n' % hc32xx['FlashSize'])
-    sys.stdout.write('RameCode:   %s\n' % hc32xx['RamCodeBinFile'])
-    sys.stdout.write('\n%s\n' % hc32xx['IspConnection'])
-    # global vars
-    base_dir = os.path.dirname(os.path.realpath(__file__))
+# 各系列整片擦除速率(KB/s)，按页大小区分；512字节页按HC32F003实测约40ms/16K，大页系列取保守值
+ERASE_KB_PER_S = {512: 400, 4096: 128, 8192: 64}
 
-    if not args.goboot and args.reboot:
-        sys.stdout.write("[REBOOT] %s\n" %
-            (transport.reboot() and 'ok' or 'error'))
-        transport.close()
-        sys.exit(0)
+def erase_estimate(hc32xx):
+    pgsize = int(hc32xx['PageSize'])
+    flash = pgsize * int(hc32xx['PageCount'])
+    return flash / 1024 / ERASE_KB_PER_S.get(pgsize, 64)
+
+def erase_deadline(hc32xx):
+    return 1.0 + 2 * erase_estimate(hc32xx)
+
+def blank_packets(dat, psize):
+    return sum(1 for ofs in range(0, len(dat), psize)
+               if dat[ofs:ofs+psize].rstrip(b'\xFF') == b'')
+
+def measure_latency(transport, baud, n=8):
+    # 以check_lock往返时间扣除线上传输时间作为链路延迟
+    wire = (10+5) * PLAN_BITS_PER_BYTE / baud
+    rtts = []
+    for _ in range(n):
+        t0 = time.time()
+        if transport.check_lock() is None: continue
+        rtts.append(max(time.time()-t0-wire, 0))
+    if not rtts: return None
+    return sorted(rtts)[len(rtts)//2]
+
+def estimate_plan(args, hc32xx, ramcode, baud, latency):
+    boot = hc32xx['BootloaderBaudrate']
+    tx = lambda n, b: n * PLAN_BITS_PER_BYTE / b
+    psize, pgsize = args.psize, int(hc32xx['PageSize'])
+    flash = pgsize * int(hc32xx['PageCount'])
+    plan = []
+    plan.append(('boot', 0.5+0.5+2 + tx(220, boot) + latency))
+    plan.append(('ramcode', tx(10+5, boot) + tx(11+len(ramcode)+1, boot) + tx(10+11, boot)
+                 + 3*latency + 0.5 + tx(13+9, boot) + latency))
+    if args.erase or args.wdata is not None:
+        plan.append(('erase', tx(9+9, baud) + latency + erase_estimate(hc32xx)))
+    if args.wdata is not None:
+        n = (len(args.wdata)+psize-1) // psize
+        n -= blank_packets(args.wdata, psize)
+        per = tx(9+psize+9, baud) + latency + psize/4*PLAN_PROGRAM_US_PER_WORD/1e6
+        plan.append(('write', n*per))
+    if args.rfile:
+        plan.append(('read', int(hc32xx['PageCount']) * (tx(9+9+pgsize, baud) + latency)))
+    if args.vdata is not None:
+        plan.append(('verify', tx(13+11, baud) + latency))
+    if args.lock:
+        plan.append(('lock', tx(9+9, baud) + latency))
+    if args.reboot:
+        plan.append(('reboot', 0.2))
+    return plan
+
+def print_plan(args, hc32xx, ramcode, latency, out):
+    out.write("[  PLAN] %s, baud %d, packet %d, latency %.1fms\n" %
+        (args.dev, args.baud, args.psize, latency*1000))
+    if args.wdata is not None:
+        n = (len(args.wdata)+args.psize-1) // args.psize
+        out.write("[  PLAN] image %d bytes, %d packets, %d blank skipped\n" %
+            (len(args.wdata), n, blank_packets(args.wdata, args.psize)))
+    plan = estimate_plan(args, hc32xx, ramcode, args.baud, latency)
+    for stage, t in plan:
+        out.write("  %-10s %8.3fs\n" % (stage, t))
+    total = sum(t for _, t in plan)
+    out.write("  %-10s %8.3fs  %.0f UPH/port\n\n" % ('total', total, 3600/total))
+    bauds = {}
+    # 部分型号的列表为晶振频率而非波特率，跳过
+    for baud in filter(str.isdigit, hc32xx['FrequecyList']):
+        bauds[baud] = round(sum(t for _, t in estimate_plan(args, hc32xx, ramcode, int(baud), latency)), 4)
+        out.write("  %-10s %8.3fs  %.0f UPH/port\n" % (baud, bauds[baud], 3600/bauds[baud]))
+    out.event('plan', device=args.dev, baud=args.baud, packet=args.psize, latency=latency,
+              stages=dict((k, round(v, 4)) for k, v in plan), total=round(total, 4), bauds=bauds)
+
+# 抓包分析：ramcode帧命令名，主机发出时带数据的命令
+RAMCODE_CMDS = {0x00: 'ack', 0x01: 'baud', 0x02: 'erase', 0x03: 'page', 0x04: 'write',
+                0x05: 'read', 0x06: 'verify', 0x07: 'blank', 0x09: 'lock'}
+RAMCODE_DATA_CMDS = (0x01, 0x04, 0x06)
+
+def uart_decode(tx, rx, baud):
+    # 两路电平[(t, level)]按时间先后解码8N1，设置波特率命令应答后切换到新波特率
+    chans = []
+    for d, edges in (('W', tx), ('R', rx)):
+        chans.append({'dir': d, 't': [e[0] for e in edges], 'lv': [e[1] for e in edges], 'i': 0, 'from': 0.0})
+    def level(ch, t):
+        i = bisect.bisect_right(ch['t'], t) - 1
+        return ch['lv'][i] if i >= 0 else 1
+    out, last, switch = [], deque(maxlen=13), None
+    while True:
+        cands = []
+        for ch in chans:
+            i = ch['i']
+            while i < len(ch['t']) and (ch['lv'][i] != 0 or ch['t'][i] < ch['from']):
+                i += 1
+            ch['i'] = i
+            if i < len(ch['t']):
+                cands.append((ch['t'][i], ch['dir'], ch))
+        if not cands:
+            return out
+        t0, d, ch = min(cands, key=lambda x: x[0])
+        bit = 1.0 / baud
+        ch['i'] += 1
+        if level(ch, t0+0.5*bit) != 0: # 毛刺，非起始位
+            continue
+        val = sum(level(ch, t0+(k+1.5)*bit) << k for k in range(8))
+        ch['from'] = t0 + 9.5*bit
+        out.append((d, t0, val, 10*bit))
+        if d == 'W':
+            last.append(val)
+            f = bytes(last)
+            if f[:2] == b'\x49\x01' and f[6:8] == b'\x04\x00' and sum(f[:-1])&0xFF == f[-1]:
+                switch = [struct.unpack('<I', f[8:12])[0], 9]
+        elif switch:
+            switch[1] -= 1
+            if switch[1] == 0: # 应答仍为旧波特率，之后切换
+                baud, switch = switch[0], None
+
+def load_capture(path, baud):
+    # 抓包或trace -> [(方向W/R, 起始时间, 字节, 字节时长)]
+    if path.endswith('.logicdata'):
+        raise ValueError("%s: Saleae .logicdata is not readable, "
+                         "export it as CSV (File > Export Data) and analyze that" % path)
+    with open(path, "rb") as fp:
+        magic = fp.read(8)
+    if magic == TRACE_MAGIC:
+        header, records = load_trace(path)
+        baud = header.get('boot_baud', baud)
+        out, wend = [], 0.0
+        for kind, t, dat in records:
+            if kind == b'B':
+                baud = struct.unpack('<I', dat)[0]
+                continue
+            bt = 10.0 / baud
+            # 写入记录为交给驱动的时刻，读出记录为收齐的时刻，应答不早于请求发完
+            if kind == b'W':
+                t0, wend = t, t + len(dat)*bt
+            else:
+                t0 = max(t - len(dat)*bt, wend)
+            out += [(kind.decode(), t0+i*bt, b, bt) for i, b in enumerate(dat)]
+        return out
+    with open(path, "r", newline='') as fp:
+        rows = list(csv.reader(fp))
+    head = [h.strip().lower() for h in rows[0]]
+    if head[:4] == ['name', 'type', 'start_time', 'duration']:
+        # Logic 2 Async Serial分析器导出，按分析器名区分方向
+        names, out = [], []
+        for r in rows[1:]:
+            if len(r) < 5 or r[1] != 'data': continue
+            if r[0] not in names: names.append(r[0])
+            rx = 'rx' in r[0].lower() or (names.index(r[0]) == 1 and not any('rx' in n.lower() for n in names))
+            out.append((rx and 'R' or 'W', float(r[2]), int(r[4], 0), float(r[3])))
+        return out
+    # 逐变化点导出的数字通道：Time[s], 通道...
+    cols = list(range(1, len(head)))
+    tx = [c for c in cols if 'tx' in head[c]] or cols[:1]
+    rx = [c for c in cols if 'rx' in head[c]] or cols[1:2]
+    if not tx or not rx or tx == rx:
+        raise ValueError("%s: need TX and RX channels" % path)
+    edges = {tx[0]: [], rx[0]: []}
+    for r in rows[1:]:
+        for c, e in edges.items():
+            lv = int(r[c])
+            if not e or e[-1][1] != lv:
+                e.append((float(r[0]), lv))
+    return uart_decode(edges[tx[0]], edges[rx[0]], baud)
+
+def capture_packets(stream):
+    # 同方向连续字节合为一包，间隔超过2字节时长或ramcode帧收齐时断开
+    packets = []
+    for d, t, b, bt in stream:
+        p = packets and packets[-1]
+        if p and p['dir'] == d and t - p['t1'] <= 2*bt and not p['done']:
+            p['data'].append(b)
+        else:
+            p = {'dir': d, 't0': t, 'data': bytearray([b]), 'done': False}
+            packets.append(p)
+        p['t1'] = t + bt
+        dat = p['data']
+        if dat[0] == 0x49 and len(dat) >= 8:
+            size = struct.unpack_from('<H', dat, 6)[0]
+            n = 9 + (size if d == 'R' or dat[1] in RAMCODE_DATA_CMDS else 0)
+            p['done'] = len(dat) >= n
+    return packets
+
+def analyze_capture(packets):
+    stat = {'duration': packets and round(packets[-1]['t1']-packets[0]['t0'], 6) or 0.0,
+            'host_bytes': sum(len(p['data']) for p in packets if p['dir'] == 'W'),
+            'device_bytes': sum(len(p['data']) for p in packets if p['dir'] == 'R')}
+    cmds, queue, prev = {}, deque(), None
+    for p in packets:
+        dat = p['data']
+        if p['dir'] == 'W':
+            cmd = dat[0] == 0x49 and len(dat) >= 9 and RAMCODE_CMDS.get(dat[1]) or 'boot'
+            c = cmds.setdefault(cmd, {'n': 0, 'bytes': 0, 'ack': [], 'gap': [], 't0': p['t0'], 't1': p['t1']})
+            c['n'] += 1
+            c['bytes'] += cmd == 'write' and len(dat)-9 or 0
+            if prev and prev['dir'] == 'R': # 主机收到上一应答到发出本帧的间隔
+                c['gap'].append(p['t0']-prev['t1'])
+            if cmd == 'boot': # bootloader阶段可能连续多包只有一个应答，按最后一包计
+                queue = deque(x for x in queue if x[0] is not cmds['boot'])
+            queue.append((c, p))
+        elif queue:
+            c, w = queue.popleft()
+            c['ack'].append(p['t0']-w['t1'])
+            c['t1'] = p['t1']
+        prev = p
+    avg_ms = lambda x: round(sum(x)*1000/len(x), 3) if x else None
+    for name, c in cmds.items():
+        stat[name] = {'n': c['n'], 'ack_ms': avg_ms(c['ack']), 'gap_ms': avg_ms(c['gap']),
+                      'time': round(c['t1']-c['t0'], 6)}
+        if name == 'write' and c['bytes']:
+            stat[name]['kbps'] = c['bytes']/1024.0/max(c['t1']-c['t0'], 1e-6)
+            stat[name]['ms_pkt'] = (c['t1']-c['t0'])*1000/c['n']
+    return stat
 
+def print_analysis(args, hc32xx, out):
+    stats = []
+    for path in args.analyze:
+        try:
+            packets = capture_packets(load_capture(path, hc32xx['BootloaderBaudrate']))
+        except (OSError, ValueError, IndexError) as e:
+            out.write("[ANALYZE] %s\n" % e)
+            continue
+        stat = analyze_capture(packets)
+        out.write("[ANALYZE] %s: %d packets, host %d bytes, device %d bytes, %.3fs\n" %
+            (path, len(packets), stat['host_bytes'], stat['device_bytes'], stat['duration']))
+        stats.append((os.path.basename(path), stat))
+        out.event('analyze', file=path, packets=len(packets), stats=stat)
+    if not stats:
+        return 1
+    rows = [('total s', 'duration', None)]
+    for name in ['boot'] + [v for v in RAMCODE_CMDS.values() if v != 'ack']:
+        if any(name in s for _, s in stats):
+            rows += [('%s n' % name, name, 'n'), ('%s s' % name, name, 'time'),
+                     ('%s ack ms' % name, name, 'ack_ms'), ('%s gap ms' % name, name, 'gap_ms')]
+            if name == 'write':
+                rows += [('write ms/pkt', name, 'ms_pkt'), ('write KB/s', name, 'kbps')]
+    out.write("\n  %-16s" % '' + ''.join("%14s" % n[-13:] for n, _ in stats) + "\n")
+    for label, key, sub in rows:
+        vals = [s.get(key) for _, s in stats]
+        vals = [v if sub is None else v and v.get(sub) for v in vals]
+        cells = ''.join(v is None and "%14s" % '-' or isinstance(v, int) and "%14d" % v or "%14.3f" % v
+                        for v in vals)
+        out.write("  %-16s%s\n" % (label, cells))
+    return 0
+
+# 结果对象中的错误码
+ERROR_CODES = {None: 0, 'boot': 2, 'locked': 3, 'ramcode': 4, 'baud': 5, 'inject': 6,
+               'write': 7, 'read': 8, 'verify': 9, 'lock': 10, 'smoke': 11, 'image': 12,
+               'port': 13, 'erase': 14, 'device': 15}
+
+class Reporter():
+    """Text or JSON-lines output, terminal writes throttled to `refresh` seconds
+    """
+    def __init__(self, stream=sys.stdout, json_mode=False, quiet=False, refresh=0.1):
+        self.stream = stream
+        self.json = json_mode
+        self.quiet = quiet or json_mode
+        self.refresh = refresh
+        self.buf, self.last = [], 0
+        self.t0 = time.time()
+        self.stages, self.timings, self.fields = {}, {}, {}
+        self.last_progress = 0
+
+    def write(self, s):
+        if not self.quiet:
+            self.buf.append(s)
+            if '\n' in s: self.emit()
+        return len(s)
+
+    def flush(self):
+        if self.buf and time.time()-self.last >= self.refresh:
+            self.emit()
+
+    def emit(self):
+        self.stream.write(''.join(self.buf))
+        self.stream.flush()
+        self.buf, self.last = [], time.time()
+
+    def event(self, name, **kw):
+        if self.json:
+            kw = dict(event=name, t=round(time.time()-self.t0, 4), **kw)
+            self.stream.write(json.dumps(kw) + '\n')
+            self.stream.flush()
+
+    def set(self, **kw):
+        self.fields.update(kw)
+
+    def count(self, name, n=1):
+        self.fields[name] = self.fields.get(name, 0) + n
+
+    def begin(self, stage):
+        self.stages[stage] = time.time()
+        self.last_progress = 0
+        self.event('stage', stage=stage, state='start')
+
+    def end(self, stage, ok=True, **kw):
+        elapsed = time.time() - self.stages.get(stage, self.t0)
+        self.timings[stage] = round(elapsed, 4)
+        self.event('stage', stage=stage, state='end', ok=bool(ok), elapsed=round(elapsed, 4), **kw)
+
+    def progress(self, stage, done, total, interval=0.2):
+        now = time.time()
+        if not self.json or (now-self.last_progress < interval and done < total):
+            return
+        self.last_progress = now
+        rate = done / max(now - self.stages.get(stage, self.t0), 1e-6)
+        self.event('progress', stage=stage, bytes=done, total=total,
+                   percent=round(100.0*done/max(total, 1), 1), rate=round(rate),
+                   eta=round((total-done)/rate, 2) if done else None)
+
+    def result(self, err, **kw):
+        self.emit() if self.buf else None
+        fields = dict(self.fields, **kw)
+        self.event('result', ok=not err, error=err, code=ERROR_CODES.get(err, 1),
+                   elapsed=round(time.time()-self.t0, 4), timings=self.timings, **fields)
+
+
+def parse_timeouts(text):
+    # "erase=5,write=0.05" -> {'erase': 5.0, 'write': 0.05}
+    timeouts = {}
+    for item in filter(None, (text or '').split(',')):
+        k, _, v = item.partition('=')
+        timeouts[k.strip()] = float(v)
+    return timeouts
+
+def open_transport(args, hc32xx, wait=False):
+    while True:
+        try:
+            link = args.replay and ReplaySerial(args.replay)
+            transport = SerialTransport(args.port or (link and link.port), hc32xx['BootloaderBaudrate'],
+                                        dir1=args.dir1, lean=args.lean, link=link, half_duplex=args.half_duplex)
+            break
+        except TransportError:
+            if not wait: raise
+        time.sleep(0.5) # 等待串口重新插入
+    if args.trace:
+        transport.serial = TraceSerial(transport.serial, args.trace)
+    # 整片擦除超时按容量及系列擦除速率估算
+    transport.timeouts['erase'] = erase_deadline(hc32xx)
+    transport.timeouts.update(args.timeouts)
+    # 网络串口默认4帧流水线，本地串口保持逐包应答
+    args.window = args.window or (transport.network and 4 or 1)
+    if args.goboot and args.port.startswith('socket://'):
+        # rfc2217可转发RTS/DTR，raw socket不能，只能手动复位
+        sys.stderr.write("socket:// has no RTS/DTR, press reset key by hand\n")
+    if args.latency_timer and not transport.network and not args.replay and \
+            not transport.set_latency_timer(args.latency_timer, args.sysfs):
+        sys.stderr.write("latency_timer: not supported on %s\n" % transport.serial.port)
+    return transport
+
+def enter_bootloader(args, transport, out):
     # stage 1. goto bootloader
-    sys.stdout.write("Stage 1. Goto bootloader: ")
-    sys.stdout.flush()
+    out.begin('boot')
+    out.write("Stage 1. Goto bootloader: ")
+    out.flush()
     _err = 0
     if not args.goboot: # 需手动进入复位
-        sys.stdout.write("wait press reset key ")
-        sys.stdout.flush()
+        out.write("wait press reset key ")
+        out.flush()
         while not transport.wait_bootloader():
-            sys.stdout.write(".")
-            sys.stdout.flush()
+            out.write(".")
+            out.flush()
             _err += 1
             if _err > 30: # 等待最多30s
-                sys.stdout.write("error\n")
-                sys.exit(1)
+                out.write("error\n")
+                out.end('boot', False)
+                return False
     # 使用控制脚自动进入复位
     while not transport.goto_bootloader():
-        sys.stdout.write("+")
-        sys.stdout.flush()
+        out.write("+")
+        out.flush()
         _err += 1
         if _err > (args.goboot and 30 or 0):
-            sys.stdout.write("error\n")
-            sys.exit(1)
-    sys.stdout.write("succ\n")
+            out.write("error\n")
+            out.end('boot', False)
+            return False
+    out.write("succ\n")
+    if transport.half_duplex:
+        # 单线上请求与应答不能重叠，不做流水线
+        args.window = 1
+        if not args.half_duplex:
+            args.half_duplex = True
+            out.write("[  LINK] single-wire echo detected, half-duplex\n")
+            out.event('link', half_duplex=True)
+    out.end('boot')
+    return True
 
+def connect_ramcode(args, transport, hc32xx, ramcode, out):
     # state 2. Check device
-    sys.stdout.write("Stage 2. Check device: ")
-    if transport.check_lock():
+    out.begin('check')
+    out.write("Stage 2. Check device: ")
+    locked = transport.check_lock()
+    if locked:
         if args.unlock and transport.unlock():
-            sys.stdout.write("unlock\n")
+            out.write("unlock\n")
         else:
-            sys.stdout.write("%s\n" % (args.unlock and "unlock failed" or "locked"))
-            sys.exit(1)
+            out.write("%s\n" % (args.unlock and "unlock failed" or "locked"))
+            out.end('check', False, locked=True)
+            return 'locked'
     else:
-        sys.stdout.write("pass\n")
+        out.write("pass\n")
+    out.end('check', locked=bool(locked))
 
     # stage 3. load ramcode
-    sys.stdout.write("Stage 3. Load ramcode: ")
-    sys.stdout.flush()
-    _f = os.path.join(base_dir, 'hdsc', 'XHSC.'+hc32xx['RamCodeBinFile'])
-    if transport.load_ramcode(_f):
-        sys.stdout.write("%s\n" % hc32xx['RamCodeBinFile'])
+    out.begin('ramcode')
+    out.write("Stage 3. Load ramcode: ")
+    out.flush()
+    if transport.load_ramcode(ramcode):
+        out.write("%s\n" % hc32xx['RamCodeBinFile'])
     else:
-        sys.stdout.write("error\n")
-        sys.exit(1)
+        out.write("error\n")
+        out.end('ramcode', False)
+        return 'ramcode'
 
     # stage 4. run ramcode
-    sys.stdout.write("Stage 4. Run ramcode: %s\n" %
+    out.write("Stage 4. Run ramcode: %s\n" %
         transport.run_ramcode())
     time.sleep(0.5) # delay for boot
+    out.end('ramcode')
 
     # stage 5. set baud
-    sys.stdout.write("Stage 5. Set baud: ")
+    out.begin('baud')
+    out.write("Stage 5. Set baud: ")
     if transport.set_baud(args.baud):
-        sys.stdout.write("%s\n\n" % args.baud)
+        out.write("%s\n\n" % args.baud)
         transport.init_baud(args.baud)
     else:
-        sys.stdout.write("error\n")
-        sys.exit(1)
+        out.write("error\n")
+        out.end('baud', False)
+        return 'baud'
+    out.end('baud', baud=args.baud)
+    return None
+
+class LinkMonitor():
+    """Sliding window of ack results, steps the baud down through FrequecyList
+    """
+    def __init__(self, args, hc32xx, size=32, limit=4, retries=5):
+        self.args, self.hc32xx = args, hc32xx
+        self.window = deque(maxlen=size)
+        self.limit, self.retries = limit, retries
+        self.tries = {}
+
+    def record(self, ok):
+        self.window.append(ok)
+
+    def recover(self, transport, out, addr):
+        self.tries[addr] = self.tries.get(addr, 0) + 1
+        if self.tries[addr] > self.retries:
+            return False
+        # 流水线中已发出帧的应答可能仍在路上，等一个读超时(已含窗口内帧的线上时间)再清空
+        time.sleep(max(transport.serial.timeout or 0, 0.05))
+        transport.purge()
+        if self.window.count(False) >= self.limit:
+            return self.step_down(transport, out, addr)
+        return True
+
+    def step_down(self, transport, out, addr):
+        args = self.args
+        lower = [int(b) for b in self.hc32xx['FrequecyList'] if b.isdigit() and int(b) < args.baud]
+        if not lower:
+            return True # 已是最低波特率，仅重试
+        baud = max(lower)
+        for _ in range(3):
+            if transport.set_baud(baud):
+                transport.init_baud(baud)
+                break
+            time.sleep(0.05)
+            transport.purge()
+        else:
+            return False
+        out.write("\n[  BAUD] %d/%d ack errors, %d -> %d at 0x%08X\n" %
+            (self.window.count(False), len(self.window), args.baud, baud, addr))
+        out.event('baud', old=args.baud, new=baud, addr=addr, errors=self.window.count(False))
+        # 记入站点配置，便于后续直接使用较低波特率
+        profile = load_profile(args.profile)
+        entry = profile.setdefault(profile_key(args), {})
+        entry['Fallbacks'] = entry.get('Fallbacks', 0) + 1
+        entry['FallbackBaud'] = baud
+        save_profile(args.profile, profile)
+        args.baud = baud
+        self.window.clear()
+        return True
+
+def transfer(args, transport, hc32xx, out, items, send):
+    # 按顺序收发，失败的包及其后已发出的包重新排队；启用--fallback时出错率过高则降低波特率
+    monitor = args.fallback and LinkMonitor(args, hc32xx) or None
+    todo, sent = deque(), deque()
+    items = iter(items)
+    def feed():
+        while True:
+            item = todo.popleft() if todo else next(items, None)
+            if item is None: return
+            sent.append(item)
+            yield item
+    while True:
+        failed = None
+        for addr, res in send(feed()):
+            item = sent.popleft()
+            if monitor: monitor.record(bool(res))
+            if not res:
+                failed = item
+                break
+            yield addr, res
+        if failed is None:
+            return
+        if not monitor or not monitor.recover(transport, out, failed[0]):
+            yield failed[0], None
+            return
+        out.count('retries')
+        todo.extendleft(reversed([failed] + list(sent)))
+        sent.clear()
+
+# 只有大页型号的整片擦除慢到值得逐扇区擦除
+SECTOR_ERASE_PAGE = 8192
+
+def probe_sector_erase(args, transport, hc32xx, out):
+    """Find out once per device/adapter/baud what the ramcode does with page erase
+
+    Returns 'overlap' when a write frame sent behind an erase frame is still
+    received intact, 'page' when page erase works but must not overlap, None
+    when the ramcode does not erase pages. Leaves the first sector blank.
+    """
+    profile = load_profile(args.profile)
+    entry = profile.get(profile_key(args), {})
+    if 'SectorErase' in entry:
+        return entry['SectorErase']
+    addr0 = int(hc32xx['StartAddress'], 16)
+    pgsize, psize = int(hc32xx['PageSize']), int(hc32xx['WritePacketSize'])
+    zero = b'\x00'*psize
+    out.write("[ PROBE] page erase ")
+    out.flush()
+    # 1. 擦除帧后紧跟写入帧，两者都应答且读回为写入内容，说明擦除期间串口仍在接收
+    frames = [(addr0, SerialTransport.ramcode_api(0x03, addr0, b'')),
+              (addr0, SerialTransport.ramcode_api(0x04, addr0, zero))]
+    overlap = all(ok for _, ok in transport.flash_write_pipelined(frames, 2))
+    overlap = overlap and transport.flash_read(addr0, psize) == zero
+    if not overlap:
+        time.sleep(transport.timeouts['page'])
+        transport.purge()
+    # 2. 写入非空数据后按页擦除，整个扇区读回全0xFF说明页擦除有效
+    mode = None
+    if transport.flash_write(addr0, zero) and transport.flash_erase_page(addr0):
+        mode = 'page'
+        for ofs in range(0, pgsize, psize):
+            if transport.flash_read(addr0+ofs, psize) != b'\xFF'*psize:
+                mode = None
+                break
+    if mode and overlap:
+        mode = 'overlap'
+    out.write("%s\n" % {None: 'not supported, full erase', 'page': 'ok, no overlap',
+                         'overlap': 'ok, overlapped with transfer'}[mode])
+    out.event('probe', sector_erase=mode)
+    profile.setdefault(profile_key(args), {})['SectorErase'] = mode
+    save_profile(args.profile, profile)
+    return mode
+
+def exec_flash(args, transport, hc32xx, unit, out):
+    # 芯片上已是上一版镜像(--watch)时只擦写有变化的页
+    pgsize = int(hc32xx['PageSize'])
+    pages = None
+    if args.base is not None and args.wdata is not None and not args.erase:
+        pages = set(changed_pages(args.base, args.wdata, pgsize))
+    patched = unit['frames']
+    count = max([len(args.frames)] + [i+1 for i in patched])
+    # --sector-erase：只擦除镜像覆盖的扇区，ramcode允许时与写入重叠进行
+    nsec = mode = None
+    if args.sector_erase and pages is None and args.wdata is not None and not args.erase:
+        mode = probe_sector_erase(args, transport, hc32xx, out)
+        if mode:
+            nsec = min(-(-count*args.psize//pgsize), int(hc32xx['PageCount']))
+
+    # erase device
+    if args.erase or args.wdata is not None or args.wstream:
+        out.begin('erase')
+        if nsec is not None:
+            out.write("[ ERASE] %d sectors, %s\n" % (nsec, mode == 'overlap'
+                and 'overlapped with write' or 'each before its data, no overlap'))
+            out.end('erase', sectors=nsec, overlap=mode == 'overlap')
+        elif pages is not None:
+            out.write("[ ERASE] %d pages " % len(pages))
+            t0, addr0 = time.time(), int(hc32xx['StartAddress'], 16)
+            for idx in sorted(pages):
+                if not transport.flash_erase_page(addr0+idx*pgsize):
+                    out.write("error at 0x%08X\n" % (addr0+idx*pgsize))
+                    out.end('erase', False, pages=len(pages))
+                    return 'erase'
+                out.write("."); out.flush()
+            out.write(" ok, %.2fs\n" % (time.time()-t0))
+            out.end('erase', pages=len(pages))
+        elif args.blank_check and blank_check(transport, hc32xx):
+            out.write("[ ERASE] skipped, blank\n")
+            out.set(erase_skipped=True)
+            out.end('erase', skipped=True)
+        else:
+            out.write("[ ERASE] ")
+            flash = int(hc32xx['PageSize']) * int(hc32xx['PageCount'])
+            est = erase_estimate(hc32xx)
+            tick = [1.0]
+            def progress(elapsed, deadline):
+                if elapsed >= tick[0]: # 每秒一个点
+                    tick[0] += 1.0
+                    out.write("."); out.flush()
+                out.progress('erase', int(flash*min(elapsed/max(est, 1e-6), 0.99)), flash)
+            t0 = time.time()
+            ok = transport.flash_erase(progress)
+            out.write("%s, %.2fs\n" % (ok and 'ok' or 'error', time.time()-t0))
+            if ok and pgsize >= SECTOR_ERASE_PAGE:
+                save_erase_time(args, time.time()-t0)
+            out.set(erase_skipped=False)
+            out.end('erase', ok, skipped=False, estimate=round(est, 3),
+                    deadline=round(transport.timeouts['erase'], 3))
+            if not ok:
+                return 'erase'
+
+    # write, with erase
+    if args.wdata is not None or args.wstream:
+        out.begin('write')
+        out.write("[ WRITE] ")
+        psize = args.psize
+        addr0 = int(hc32xx['StartAddress'], 16)
+        ops0, npkt = sum(transport.stats.values()), 0
+        t0, c0 = time.time(), time.process_time()
+        stream = args.wstream
+
+        def frames():
+            if stream: # 边解压边写，帧随数据到达即时编码
+                for idx, pkt in enumerate(stream.packets()):
+                    pkt = pkt + b'\xFF'*(psize-len(pkt))
+                    if pkt.rstrip(b'\xFF') == b'':
+                        out.write("_"); out.flush()
+                        continue
+                    yield addr0+idx*psize, SerialTransport.ramcode_api(0x04, addr0+idx*psize, pkt)
+                return
+            for idx in range(count):
+                if pages is not None and not any(p in pages for p in
+                        range(idx*psize//pgsize, ((idx+1)*psize-1)//pgsize+1)):
+                    continue
+                if idx in patched:
+                    addr, frame = patched[idx]
+                elif idx < len(args.frames):
+                    addr, frame = args.frames[idx]
+                else:
+                    addr, frame = addr0+idx*psize, None
+                if frame is None: # 擦除后即为0xFF，跳过空白包
+                    out.write("_"); out.flush()
+                    continue
+                yield addr, frame
+
+        def interleave(feed):
+            # 写第k扇区前先发出第k+1扇区的擦除，擦除在流水线中与第k扇区的数据传输重叠
+            erase = lambda k: (addr0+k*pgsize, SerialTransport.ramcode_api(0x03, addr0+k*pgsize, b''))
+            k = 0
+            yield erase(0)
+            if nsec > 1: yield erase(1)
+            for addr, frame in feed:
+                while (addr-addr0)//pgsize > k:
+                    k += 1
+                    if k+1 < nsec: yield erase(k+1)
+                yield addr, frame
+            while k+1 < nsec: # 镜像尾部全空白的扇区
+                k += 1
+                if k+1 < nsec: yield erase(k+1)
+
+        # 探测确认擦除期间可接收时才至少保持两帧在途，否则逐帧等待应答，不重叠
+        window = mode == 'overlap' and max(args.window, 2) or args.window
+        if window > 1: # 流水线发送，应答按顺序核对
+            send = lambda feed: transport.flash_write_pipelined(feed, window)
+        else:
+            send = lambda feed: ((addr, transport.flash_write(addr, None, frame)) for addr, frame in feed)
+        erased, done = {}, {}
+        for addr, ok in transfer(args, transport, hc32xx, out, nsec and interleave(frames()) or frames(), send):
+            if not ok:
+                out.write("flash write error: 0x%08X\n" % addr)
+                out.end('write', False, addr=addr)
+                return 'write'
+            if nsec is not None:
+                k = (addr-addr0)//pgsize
+                # 扇区首地址的第一个应答是擦除应答(擦除总在该扇区写入之前)
+                if (addr-addr0) % pgsize == 0 and k not in erased:
+                    erased[k] = time.time()
+                    continue
+                done[k] = time.time() # 该扇区最后一个写入应答
+            out.write("."); out.flush()
+            if stream: count = -(-stream.size//psize) # 流式输入总长未知，按已到达计
+            out.progress('write', addr-addr0+psize, count*psize)
+            npkt += 1
+        if stream:
+            count = -(-stream.size//psize)
+            unit['vsum'], unit['vlen'] = stream.sum & 0xFFFF, stream.size
+        out.progress('write', count*psize, count*psize)
+        out.write(" ok\n")
+        stat = {}
+        if npkt:
+            # 逐包耗时与线上传输时间之差即为主机、链路延迟及编程开销
+            wire = (9+psize+9) * PLAN_BITS_PER_BYTE / args.baud
+            stat = dict(packets=npkt, io=round((sum(transport.stats.values())-ops0)/npkt, 2),
+                        ms=round((time.time()-t0)*1000/npkt, 3), wire_ms=round(wire*1000, 3),
+                        cpu_ms=round((time.process_time()-c0)*1000/npkt, 4))
+            out.write("[  STAT] %(packets)d pkts, %(io).1f io/pkt, %(ms).2fms/pkt (wire %(wire_ms).2fms), "
+                      "cpu %(cpu_ms).3fms/pkt\n" % stat)
+        if nsec:
+            # 写入扇区k的周期为上一写入扇区最后应答到本扇区最后应答，各周期之和即总耗时；
+            # 只擦不写的扇区(空白)的擦除计入所在周期
+            ts = [t0] + [done[k] for k in sorted(done)]
+            cycles = [(k, (b-a)*1000) for k, a, b in zip(sorted(done), ts, ts[1:])]
+            ms = [c for k, c in cycles] or [0.0]
+            total = ts[-1]-t0
+            full = load_profile(args.profile).get(profile_key(args), {}).get('EraseTime')
+            out.write("[SECTOR] %d sectors (%d erase only), %.1fms/sector (min %.1f, max %.1f), "
+                      "erase+write %.2fs, %s\n" % (len(erased), len(erased)-len(cycles),
+                      sum(ms)/len(ms), min(ms), max(ms), total, full is None and
+                      'full erase not measured yet' or 'full erase alone %.2fs' % full))
+            for k, c in cycles:
+                out.event('sector', index=k, addr='0x%08X' % (addr0+k*pgsize), ms=round(c, 3))
+            stat.update(sectors=len(erased), sector_ms=round(sum(ms)/len(ms), 3),
+                        sector_total=round(total, 3), full_erase=full)
+        out.end('write', **stat)
+    return 0
+
+def program_device(args, transport, hc32xx, ramcode, out):
+    err = connect_ramcode(args, transport, hc32xx, ramcode, out)
+    if err: return err
+
+    # 每个会话只调优一次，且仅在随后本就整片擦除时进行
+    if args.autotune and args.wdata is not None and args.base is None:
+        args.autotune = False
+        args.psize = autotune_packet(args, transport, hc32xx, out) or args.psize
+        args.frames = build_frames(args.wdata, args.psize, int(hc32xx['StartAddress'], 16))
+
+    try:
+        unit = prepare_unit(args, hc32xx)
+    except (ValueError, KeyError) as e:
+        out.write("[INJECT] error: %s\n" % e)
+        out.event('inject', ok=False, error=str(e))
+        return 'inject'
+    for addr, val in unit['values']:
+        out.write("[INJECT] 0x%08X %s\n" % (addr, val.hex()))
+    if unit['values']:
+        out.set(unit=unit['n'], inject=[['0x%08X' % a, v.hex()] for a, v in unit['values']])
+
+    err = program_unit(args, transport, hc32xx, unit, out)
+    log_unit(args, unit, err)
+    return err
 
-    def exec_flash(args, transport):
-        # erase device
-        if args.erase or args.wfile:
-            sys.stdout.write("[ ERASE] %s\n" %
-                (transport.flash_erase() and 'ok' or 'error'))
-
-        # write, with erase
-        if args.wfile:
-            with open(args.wfile, "rb") as fs:
-                sys.stdout.write("[ WRITE] ")
-                psize = int(hc32xx['WritePacketSize'])
-                addr0 = int(hc32xx['StartAddress'], 16)
-                addr = addr0
-                while True:
-                    _last = False
-                    dat = fs.read(psize)
-                    if len(dat) == 0:
-                        _last = True
-                    else:
-                        if len(dat) < psize:
-                            dat = dat + b'\xFF'*(psize-len(dat))
-                            _last = True
-                        if transport.flash_write(addr, dat):
-                            sys.stdout.write("."); sys.stdout.flush()
-                        else:
-                            sys.stdout.write("flash write error: 0x%08X\n" % addr)
-                            #sys.exit(1)
-                            return 1
-                    addr += psize
-                    if _last:
-                        sys.stdout.write(" ok\n")
-                        fs.close()
-                        if not args.vfile:
-                            args.vfile = args.wfile
-                        break
-        return 0
+def unit_image(args, hc32xx, unit):
+    # 本机实际写入的镜像：流式输入的已读数据，或镜像加上注入值
+    if args.wstream:
+        return b''.join(args.wstream.chunks)
+    image = bytearray(args.vdata)
+    if args.vdata is args.wdata:
+        addr0 = int(hc32xx['StartAddress'], 16)
+        for addr, val in unit['values']:
+            ofs = addr - addr0
+            image += b'\xFF' * max(0, ofs+len(val)-len(image))
+            image[ofs:ofs+len(val)] = val
+    return bytes(image)
 
+def readback_verify(args, transport, hc32xx, image, out):
+    # 逐块读回比对，比对及SHA-256在工作线程中进行，与下一块的串口读取重叠
+    psize = int(hc32xx['PageSize'])
+    addr0 = int(hc32xx['StartAddress'], 16)
+    blocks, bad, sha = queue.Queue(), [], hashlib.sha256()
+    def check():
+        while True:
+            item = blocks.get()
+            if item is None: return
+            addr, dat = item
+            exp = image[addr-addr0:addr-addr0+psize]
+            dat = dat[:len(exp)]
+            if dat != exp:
+                i = next(i for i in range(len(exp)) if dat[i] != exp[i])
+                bad.append((addr+i, exp[i], dat[i]))
+                return
+            sha.update(dat)
+    worker = threading.Thread(target=check, daemon=True)
+    worker.start()
+    addrs = [(addr0+ofs, None) for ofs in range(0, len(image), psize)]
+    if args.window > 1:
+        send = lambda feed: transport.flash_read_pipelined((a for a, _ in feed), psize, args.window)
+    else:
+        send = lambda feed: ((addr, transport.flash_read(addr, psize)) for addr, _ in feed)
+    err = None
+    for addr, dat in transfer(args, transport, hc32xx, out, addrs, send):
+        if not dat:
+            out.write("flash read error: 0x%08X\n" % addr)
+            err = 'read'
+            break
+        if bad: break # 首个不一致即停止读取
+        blocks.put((addr, dat))
+        out.write("."); out.flush()
+        out.progress('readback', addr-addr0+psize, len(addrs)*psize)
+    blocks.put(None)
+    worker.join()
+    if (bad or err) and args.window > 1:
+        # 提前结束时流水线中仍有未读的应答
+        time.sleep(transport.serial.timeout or 0)
+        transport.purge()
+    if bad:
+        addr, exp, got = bad[0]
+        out.write(" mismatch at 0x%08X: 0x%02X/0x%02X\n" % (addr, exp, got))
+        out.set(mismatch='0x%08X' % addr)
+        return 'verify'
+    if err:
+        return err
+    digest = sha.hexdigest()
+    out.write(" sha256 %s, ok\n" % digest)
+    out.set(sha256=digest)
+    return None
+
+def program_unit(args, transport, hc32xx, unit, out):
+    err = None
     _err = 0
-    while exec_flash(args, transport) != 0:
-        sys.stdout.write(".")
-        sys.stdout.flush()
+    while True:
+        try:
+            failed = exec_flash(args, transport, hc32xx, unit, out)
+            if not failed:
+                break
+        except ImageError as e: # 输入流读取/解压失败，重试无意义
+            out.write("\n%s\n" % e)
+            out.event('image', ok=False, error=str(e))
+            return 'image'
+        if transport.pending_ack: # 整片擦除到截止时间仍无应答，重试只会再等一轮擦除超时
+            out.write("error\n")
+            return 'erase'
+        out.write(".")
+        out.flush()
+        out.count('retries')
         _err += 1
         if _err > (args.goboot and 10 or 0):
-            sys.stdout.write("error\n")
-            sys.exit(1)
-    sys.stdout.write("succ\n")
-
+            out.write("error\n")
+            return failed
+    out.write("succ\n")
 
     # read to file
     if args.rfile:
-        with open(args.rfile, "wb") as fs:
-            sys.stdout.write("[ READ ] ")
+        if args.archive: # -r的参数作为单元名存入归档
+            fs = DumpArchive(args.archive, args.rfile, dict(device=args.dev, port=args.port,
+                             time=time.strftime('%Y-%m-%dT%H:%M:%S'), image=image_hash(args)))
+        else:
+            fs = open(args.rfile, "wb")
+        with fs:
+            out.begin('read')
+            out.write("[ READ ] ")
             psize = int(hc32xx['PageSize'])
             pcnt = int(hc32xx['PageCount'])
             addr0 = int(hc32xx['StartAddress'], 16)
-            addr = addr0
-            for _ in range(pcnt):
-                dat = transport.flash_read(addr, psize)
+            addrs = [(addr0 + i*psize, None) for i in range(pcnt)]
+            if args.window > 1:
+                send = lambda feed: transport.flash_read_pipelined((a for a, _ in feed), psize, args.window)
+            else:
+                send = lambda feed: ((addr, transport.flash_read(addr, psize)) for addr, _ in feed)
+            for addr, dat in transfer(args, transport, hc32xx, out, addrs, send):
                 if not dat:
-                    sys.stdout.write("flash read error: 0x%08X\n" % addr)
-                    sys.exit(1)
+                    out.write("flash read error: 0x%08X\n" % addr)
+                    out.end('read', False, addr=addr)
+                    return 'read'
                 else:
                     fs.write(dat)
-                    sys.stdout.write("."); sys.stdout.flush()
-                addr += psize
-            sys.stdout.write(" ok\n")
-            fs.close()
+                    out.write("."); out.flush()
+                out.progress('read', addr-addr0+psize, pcnt*psize)
+            out.progress('read', pcnt*psize, pcnt*psize)
+            out.write(" ok\n")
+            out.end('read')
+            if args.archive:
+                manifest = fs.commit()
+                out.write("[ STORE] %s: %d pages, %d distinct, %d new\n" %
+                    (args.rfile, len(fs.hashes), len(manifest['palette']), fs.new))
+                out.set(archive=args.rfile, new_pages=fs.new)
 
     # verify chksum
-    if args.vfile:
-        with open(args.vfile, "rb") as fs:
-            sys.stdout.write("[VERIFY] ")
-            dat = fs.read()
-            fs.close()
-            ack = transport.flash_verify(len(dat))
-            chk0,chk1 = sum(dat)&0xFFFF,None
-            if ack:
-                chk1 = struct.unpack('<H',ack)[0]
-            if chk0 == chk1:
-                sys.stdout.write("0x%04X, ok\n" % chk0)
-            else:
-                sys.stdout.write("flash verify error: %s/%s\n" % (chk0, chk1))
+    if args.vdata is not None or args.wstream:
+        out.begin('verify')
+        out.write("[VERIFY] ")
+        ack = transport.flash_verify(unit['vlen'])
+        chk0,chk1 = unit['vsum'],None
+        if ack:
+            chk1 = struct.unpack('<H',ack)[0]
+        if chk0 == chk1:
+            out.write("0x%04X, ok\n" % chk0)
+        else:
+            out.write("flash verify error: %s/%s\n" % (chk0, chk1))
+            err = 'verify'
+        out.set(checksum=chk0, device_checksum=chk1)
+        out.end('verify', chk0 == chk1)
+
+    # read back and compare
+    if args.verify_read and not err and (args.vdata is not None or args.wstream):
+        image = unit_image(args, hc32xx, unit)
+        out.begin('readback')
+        out.write("[RDBACK] 0x%08X-0x%08X " % (int(hc32xx['StartAddress'], 16),
+                                               int(hc32xx['StartAddress'], 16)+len(image)))
+        e = readback_verify(args, transport, hc32xx, image, out)
+        out.end('readback', not e)
+        err = err or e
 
     # lock device
     if args.lock:
-        sys.stdout.write("[ LOCK ] %s\n" %
-            (transport.flash_lock() and 'ok' or 'error'))
+        out.begin('lock')
+        ok = transport.flash_lock()
+        out.write("[ LOCK ] %s\n" % (ok and 'ok' or 'error'))
+        if not ok: err = err or 'lock'
+        out.set(locked=bool(ok))
+        out.end('lock', ok)
 
     # reboot
     if args.reboot:
-        sys.stdout.write("[REBOOT] %s\n" %
-            (transport.reboot() and 'ok' or 'error'))
+        out.begin('reboot')
+        if args.smoke:
+            # 复位前切到应用波特率并清空ramcode残留，启动信息一开始就能收到
+            transport.init_baud(args.app_baud or args.baud)
+            transport.purge()
+        ok = transport.reboot()
+        out.write("[REBOOT] %s\n" % (ok and 'ok' or 'error'))
+        out.end('reboot', ok)
+        if ok and args.smoke and not err:
+            err = smoke_test(args, transport, out)
+
+    return err
+
+def smoke_pattern(text):
+    # "hex:55AA" 为原始字节，其余按字节正则
+    if text.startswith('hex:'):
+        return re.compile(re.escape(bytes.fromhex(text[4:])))
+    return re.compile(text.encode())
+
+def smoke_test(args, transport, out):
+    # 复位释放后在截止时间内等待应用输出匹配
+    out.begin('smoke')
+    out.write("[ SMOKE] %d baud, " % (args.app_baud or args.baud))
+    out.flush()
+    t0, buf, m = time.time(), b'', None
+    while m is None:
+        left = args.smoke_timeout - (time.time()-t0)
+        if left <= 0: break
+        transport.serial.timeout = min(0.05, left)
+        dat = transport.read(256)
+        if dat:
+            buf = buf[-4096:] + dat
+            m = args.smoke.search(buf)
+    t = time.time() - t0
+    if m is None:
+        out.write("no match in %.2fs, got %r\n" % (t, buf[-32:]))
+        out.set(smoke=False)
+        out.end('smoke', False)
+        return 'smoke'
+    out.write("%r after %.3fs, ok\n" % (m.group(0)[:64], t))
+    out.set(smoke=True, boot_ms=round(t*1000, 1))
+    out.end('smoke', True, boot_ms=round(t*1000, 1))
+    return None
+
+def production_loop(args, hc32xx, ramcode, out, transport=None):
+    out.write("[  LOOP] waiting for target, Ctrl-C to stop\n")
+    units, fails, t0 = 0, 0, time.time()
+    try:
+        while True:
+            try:
+                if transport is None:
+                    transport = open_transport(args, hc32xx, wait=True)
+                # 等待新的目标板进入bootloader
+                transport.init_baud(hc32xx['BootloaderBaudrate'])
+                while not transport.wait_bootloader():
+                    pass
+                t1 = time.time()
+                uout = Reporter(json_mode=args.json, quiet=True)
+                err = 'boot'
+                if enter_bootloader(args, transport, uout):
+                    err = program_device(args, transport, hc32xx, ramcode, uout)
+                t2 = time.time()
+                units += 1
+                if err: fails += 1
+                uph = units*3600/(t2-t0)
+                out.write("[  UNIT] #%04d %-8s %6.2fs  pass %d fail %d  %.0f UPH\n" %
+                    (units, err or 'ok', t2-t1, units-fails, fails, uph))
+                record_unit(args, uout, err)
+                uout.result(err, device=args.dev, port=args.port, baud=args.baud,
+                            units=units, fails=fails, uph=round(uph, 1))
+                # 等待当前目标板移除后再进入下一轮
+                transport.init_baud(hc32xx['BootloaderBaudrate'])
+                while transport.wait_bootloader():
+                    pass
+            except (serial.SerialException, OSError) as e:
+                out.write("[  LOOP] port lost: %s\n" % e)
+                out.event('port', lost=str(e))
+                try: transport.serial.close()
+                except Exception: pass
+                transport = None
+    except KeyboardInterrupt:
+        out.write("\n[  LOOP] %d units, pass %d fail %d\n" % (units, units-fails, fails))
+        out.event('loop', units=units, fails=fails)
+        if transport: transport.close()
+    return fails and 1 or 0
+
+class FileWatcher():
+    """Waits for a change of any of `paths`: inotify on their directories
+    where available, otherwise polling size/mtime every `interval` seconds
+    """
+    IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x08, 0x80, 0x100
+
+    def __init__(self, paths, interval=0.2):
+        self.paths = [os.path.abspath(p) for p in paths]
+        self.interval = interval
+        self.fd = None
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1')
+            for d in set(os.path.dirname(p) for p in self.paths):
+                mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+                if libc.inotify_add_watch(fd, d.encode(), mask) < 0:
+                    os.close(fd)
+                    raise OSError(ctypes.get_errno(), 'inotify_add_watch')
+            self.fd = fd
+        except (OSError, AttributeError):
+            pass # 非Linux或inotify不可用时轮询
+        self.last = self.state()
+
+    def state(self):
+        st = []
+        for p in self.paths:
+            try:
+                s = os.stat(p)
+                st.append((s.st_mtime_ns, s.st_size))
+            except OSError:
+                st.append(None)
+        return st
+
+    def events(self, timeout):
+        # inotify事件中是否有被监视的文件名
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+        names = set(os.path.basename(p) for p in self.paths)
+        buf, hit = os.read(self.fd, 65536), False
+        ofs = 0
+        while ofs + 16 <= len(buf):
+            wd, mask, cookie, n = struct.unpack_from('<iIII', buf, ofs)
+            name = buf[ofs+16:ofs+16+n].rstrip(b'\0').decode(errors='replace')
+            hit = hit or name in names
+            ofs += 16 + n
+        return hit
+
+    def wait(self):
+        while True:
+            if self.fd is not None:
+                self.events(None)
+            else:
+                time.sleep(self.interval)
+            if self.state() == self.last:
+                continue
+            # 等待构建写完：文件状态稳定一个周期后再读取
+            while True:
+                self.last = self.state()
+                time.sleep(self.interval)
+                if self.state() == self.last:
+                    return
+
+def watch_loop(args, hc32xx, ramcode, out, transport):
+    # 首次完整烧录，之后每次镜像变化只擦写变化的页；未复位时ramcode一直保持运行
+    watcher = FileWatcher([parse_image_spec(x)[0] for x in args.wfile])
+    uout, alive, n = out, False, 0
+    try:
+        while True:
+            t0 = time.time()
+            err = None
+            if not alive:
+                err = 'boot'
+                if enter_bootloader(args, transport, uout):
+                    err = program_device(args, transport, hc32xx, ramcode, uout)
+            else:
+                err = program_unit(args, transport, hc32xx, prepare_unit(args, hc32xx), uout)
+            record_unit(args, uout, err)
+            uout.result(err, watch=n)
+            # 出错后芯片内容未知，下次整片擦除
+            args.base = not err and args.wdata or None
+            alive = not err and not args.reboot
+            out.write("[ WATCH] #%d %s %.2fs, waiting for %s, Ctrl-C to stop\n" %
+                (n, err or 'ok', time.time()-t0, ', '.join(watcher.paths)))
+            while True:
+                watcher.wait()
+                try:
+                    wdata, segments = load_images(args.wfile, hc32xx)
+                except (OSError, ValueError) as e:
+                    out.write("[ WATCH] %s\n" % e)
+                    continue
+                if wdata != args.wdata:
+                    break
+            args.wdata = args.vdata = wdata
+            args.segments, args.image_hash = segments, None
+            args.vsum = sum(wdata) & 0xFFFF
+            args.frames = build_frames(wdata, args.psize, int(hc32xx['StartAddress'], 16))
+            if args.base is not None:
+                out.write("[ WATCH] %d pages changed\n" % len(changed_pages(args.base, wdata, int(hc32xx['PageSize']))))
+            uout = Reporter(json_mode=args.json)
+            n += 1
+    except KeyboardInterrupt:
+        out.write("\n[ WATCH] %d updates\n" % n)
+    transport.close()
+    return 0
+
+if __name__ == '__main__':
+    # parse arguments or use defaults
+    parser = argparse.ArgumentParser(description='HC32xx Flash Downloader.')
+    parser.add_argument('-l', '--list', action='store_true', help='List support device')
+    parser.add_argument('-d', metavar=' device', default='HC32F003', help='Device name, default HC32F003')
+    parser.add_argument('-p', metavar=' port', default='',
+                        help='Serial port or rfc2217:// / socket:// URL, default serial[-1]')
+    parser.add_argument('-b', metavar=' baudrate',type=int,default=0, help='Serial baudrate')
+    parser.add_argument('-u', '--unlock', action='store_true', help='Unlock. Erase device when locked')
+    parser.add_argument('-L', '--lock', action='store_true', help='Lock. SWD port disabled')
+    parser.add_argument('-R', '--reboot', action='store_true', help='Reboot device')
+    parser.add_argument('-e', '--erase', action='store_true', help='Erase device')
+    parser.add_argument('-G', '--goboot', action='store_true', help='Goto bootloader')
+    parser.add_argument('-D', '--dir1', action='store_true', help='RTS/DTR output 1 for reset')
+    parser.add_argument('-w', metavar='<filename[@addr]>', nargs='+',
+                        help='Write data from file(s) to device, each at its own address')
+    parser.add_argument('-r', metavar='<filename>', help='Read data from device to file')
+    parser.add_argument('-v', metavar='<filename>', help='Verify chksum data in device against file')
+    parser.add_argument('--archive', metavar='<dir>',
+                        help='Store -r dumps page-deduplicated in <dir>, -r names the unit')
+    parser.add_argument('--diff', metavar='<unit|image>', nargs=2, help='With --archive, compare two units or a unit and an image')
+    parser.add_argument('--extract', metavar=('<unit>', '<filename>'), nargs=2,
+                        help='With --archive, write a unit dump to a file')
+    parser.add_argument('--loop', action='store_true', help='Production loop: wait, flash, repeat for next target')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep the session, reflash only changed pages whenever the -w file changes')
+    parser.add_argument('--autotune', action='store_true', help='Tune write packet size and save it to profile')
+    parser.add_argument('--half-duplex', action='store_true',
+                        help='Single-wire TOOL0 link, echo checked and dropped; auto-detected on handshake')
+    parser.add_argument('--lean', action='store_true', help='Lean serial I/O, no per-packet drain and input check')
+    parser.add_argument('--timeout', metavar='<op=sec,..>', default='',
+                        help='Base timeouts for cmd/erase/write/read/verify/page, e.g. erase=5,write=0.05')
+    parser.add_argument('--latency-timer', metavar='<ms>', type=int, default=0,
+                        help='Set USB-serial latency_timer for this session, restored on exit')
+    parser.add_argument('--sysfs', metavar='<dir>', default='/sys/bus/usb-serial/devices',
+                        help='USB-serial sysfs root, default /sys/bus/usb-serial/devices')
+    parser.add_argument('--inject', metavar='<addr:[hex:|u32:]tpl>', action='append', default=[],
+                        help='Per-unit data patched into image, e.g. 0x3F00:u32:{n}, 0x3F10:hex:{mac}')
+    parser.add_argument('--counter', metavar='<n>', type=int, default=1, help='First unit counter {n}, default 1')
+    parser.add_argument('--csv', metavar='<filename>', help='CSV with one row per unit, columns as {fields}')
+    parser.add_argument('--inject-log', metavar='<filename>', default='inject.log',
+                        help='Injected values log, default inject.log')
+    parser.add_argument('--window', metavar='<n>', type=int, default=0,
+                        help='Write frames in flight before waiting for acks, default 4 for URLs else 1')
+    parser.add_argument('--fallback', action='store_true',
+                        help='Retry failed packets in place, step baud down when ack errors rise')
+    parser.add_argument('--smoke', metavar='<regex|hex:..>',
+                        help='After -R, wait for this application output, unit fails without it')
+    parser.add_argument('--app-baud', metavar='<baud>', type=int, default=0,
+                        help='Application baud for --smoke, default the -b baud')
+    parser.add_argument('--smoke-timeout', metavar='<sec>', type=float, default=3.0,
+                        help='--smoke deadline after reset release, default 3s')
+    parser.add_argument('--verify-read', action='store_true',
+                        help='Read back the written range, stop at first mismatch, report SHA-256')
+    parser.add_argument('--sector-erase', action='store_true',
+                        help='Erase only the image sectors, overlapped with writes (8K-page parts)')
+    parser.add_argument('--blank-check', action='store_true', help='Skip erase when device is already blank')
+    parser.add_argument('--json', action='store_true', help='JSON-lines stage/progress/result events on stdout')
+    parser.add_argument('--plan', action='store_true', help='Estimate stage and cycle time, no hardware access')
+    parser.add_argument('--measure', action='store_true', help='With --plan, measure link latency on target')
+    parser.add_argument('--profile', metavar='<filename>', default=os.path.expanduser('~/.hc32flash.json'),
+                        help='Station profile, default ~/.hc32flash.json')
+    parser.add_argument('--analyze', metavar='<capture>', nargs='+',
+                        help='Decode CSV exports of logic captures or --trace files, compare timing')
+    parser.add_argument('--db', metavar='<filename>', default=os.path.expanduser('~/.hc32flash.db'),
+                        help="Per-unit SQLite log, default ~/.hc32flash.db, '' to disable")
+    parser.add_argument('--query', choices=sorted(DB_QUERIES),
+                        help='Report from --db, filtered by --since/--until, -p and -w image')
+    parser.add_argument('--since', metavar='<date>', help='With --query, from YYYY-MM-DD[ HH:MM]')
+    parser.add_argument('--until', metavar='<date>', help='With --query, before YYYY-MM-DD[ HH:MM]')
+    parser.add_argument('--trace', metavar='<filename>', help='Record wire bytes with timestamps to a binary trace')
+    parser.add_argument('--replay', metavar='<filename>',
+                        help='Rerun a --trace session against the recorded bytes, extra options override')
+    args = parser.parse_args()
+    if args.replay:
+        # 回放时沿用录制时的参数，命令行上的其它参数可覆盖
+        try:
+            header = load_trace(args.replay)[0]
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        args = parser.parse_args(header['argv'] + sys.argv[1:])
+        args.trace = None
+        if args.loop:
+            parser.error("--replay of a --loop session is not supported")
+
+    args.dev,args.port,args.baud = args.d,args.p,args.b
+    args.rfile,args.wfile,args.vfile = args.r,args.w,args.v
+    out = Reporter(json_mode=args.json)
+    try:
+        args.timeouts = parse_timeouts(args.timeout)
+    except ValueError:
+        parser.error("invalid --timeout '%s'" % args.timeout)
+
+    # check device
+    matched_device = find_device_simple(args.dev, list(HDSC.keys()))
+    if not matched_device:
+        out.write("Invalid Device name '%s'.\n\nList of support device:\n" % args.dev)
+        args.list = True
+    else:
+        args.dev = matched_device
+
+    if args.list:
+        for dev in HDSC.keys():
+            out.write("%-28s %-8s %s\n" % (dev, HDSC[dev]['FlashSize'], HDSC[dev]['BootloaderBaudrate']))
+            out.event('device', device=dev, flash=HDSC[dev]['FlashSize'], boot_baud=HDSC[dev]['BootloaderBaudrate'])
+        if not matched_device:
+            out.result('device', message="invalid device name '%s'" % args.dev)
+        sys.exit(not matched_device and 1 or 0)
+
+    if args.analyze:
+        sys.exit(print_analysis(args, HDSC[args.dev], out))
+    if args.diff or args.extract:
+        if not args.archive:
+            parser.error("--diff/--extract require --archive")
+        try:
+            if args.extract:
+                unit = DumpArchive(args.archive).extract(*args.extract)
+                out.write("[EXTRCT] %s: %d bytes -> %s\n" % (args.extract[0], unit['size'], args.extract[1]))
+                sys.exit(0)
+            sys.exit(archive_diff(args, HDSC[args.dev], out))
+        except (OSError, ValueError) as e:
+            out.write("%s\n" % e)
+            sys.exit(2)
+    if args.archive and args.rfile:
+        try:
+            DumpArchive.check_name(args.rfile)
+        except ValueError as e:
+            parser.error(str(e))
+    # 调优要整片擦除，只在正常流程本就整片擦除时允许
+    if args.autotune and (not args.wfile or args.sector_erase or args.watch):
+        parser.error("--autotune requires -w and no --sector-erase/--watch")
+    if args.smoke:
+        if not args.reboot:
+            parser.error("--smoke requires -R")
+        if not args.goboot and not args.loop: # 否则-R只复位而不烧录
+            parser.error("--smoke requires -G or --loop")
+        try:
+            args.smoke = smoke_pattern(args.smoke)
+        except (ValueError, re.error) as e:
+            parser.error("invalid --smoke: %s" % e)
+    if args.query:
+        try:
+            sys.exit(query_db(args, HDSC[args.dev], out))
+        except (sqlite3.Error, OSError, ValueError) as e:
+            out.write("%s\n" % e)
+            sys.exit(1)
+    args.db_conn, args.image_hash = None, None
+    args.base = None
+
+    if args.trace:
+        argv, skip = [], False
+        for a in sys.argv[1:]:
+            if not skip and not a.startswith('--trace'):
+                argv.append(a)
+            skip = a == '--trace'
+        args.trace = TraceWriter(args.trace, {'argv': argv, 'device': args.dev, 'port': args.port,
+                                              'boot_baud': HDSC[args.dev]['BootloaderBaudrate'],
+                                              'time': time.time()})
+
+    # mcu info
+    hc32xx =  HDSC[args.dev]
+    args.baud = args.baud or hc32xx['BootloaderBaudrate']
+    if args.sector_erase and int(hc32xx['PageSize']) < SECTOR_ERASE_PAGE:
+        parser.error("--sector-erase is for %d-byte page parts, %s has %s" %
+                     (SECTOR_ERASE_PAGE, args.dev, hc32xx['PageSize']))
+    # global vars
+    base_dir = os.path.dirname(os.path.realpath(__file__))
+
+    # 镜像及ramcode只读取一次，常驻内存
+    _f = os.path.join(base_dir, 'hdsc', 'XHSC.'+hc32xx['RamCodeBinFile'])
+    with open(_f, "rb") as fr:
+        ramcode = fr.read()
+    args.wdata = args.vdata = args.wstream = None
+    args.segments = []
+    # 单个压缩镜像或标准输入，且无需整镜像参与的功能时，边读边写
+    if args.wfile and len(args.wfile) == 1 and not (args.loop or args.watch or args.inject or args.plan
+            or args.autotune or args.vfile):
+        path, addr = parse_image_spec(args.wfile[0])
+        if (path == '-' or path.endswith(STREAM_SUFFIXES)) and addr in (None, int(hc32xx['StartAddress'], 16)):
+            args.wstream = path
+    if args.wfile and not args.wstream:
+        try:
+            args.wdata, args.segments = load_images(args.wfile, hc32xx)
+        except (OSError, ValueError) as e:
+            out.write("%s\n" % e)
+            out.result('image', message=str(e))
+            sys.exit(1)
+        args.vdata = args.wdata
+    if args.vfile:
+        with open(args.vfile, "rb") as fs:
+            args.vdata = fs.read()
+    args.vsum = args.vdata is not None and sum(args.vdata)&0xFFFF or 0
+    try:
+        args.inject = [parse_inject(x) for x in args.inject]
+    except ValueError:
+        parser.error("invalid --inject")
+    if args.inject and args.wdata is None:
+        parser.error("--inject requires -w")
+    if args.watch and (args.wdata is None or args.loop or args.inject or '-' in args.wfile):
+        parser.error("--watch requires -w files, without --loop/--inject")
+    args.csv_rows = None
+    if args.csv:
+        with open(args.csv, "r", newline='') as fp:
+            args.csv_rows = list(csv.DictReader(fp))
+
+    if args.plan and not args.measure:
+        args.adapter = adapter_id(args.port)
+        profile = load_profile(args.profile)
+        args.psize = profile.get(profile_key(args), {}).get(
+            'WritePacketSize', int(hc32xx['WritePacketSize']))
+        latency = profile.get('adapter|%s' % args.adapter, {}).get('Latency', PLAN_LATENCY)
+        print_plan(args, hc32xx, ramcode, latency, out)
+        sys.exit(0)
+
+    try:
+        transport = open_transport(args, hc32xx)
+    except TransportError as e:
+        out.write("%s\n" % e)
+        out.result('port', message=str(e))
+        sys.exit(1)
+    args.port = transport.serial.port
+    args.adapter = adapter_id(args.port)
+    args.psize = load_profile(args.profile).get(profile_key(args), {}).get(
+        'WritePacketSize', int(hc32xx['WritePacketSize']))
+    args.frames = []
+    if args.wdata is not None:
+        args.frames = build_frames(args.wdata, args.psize, int(hc32xx['StartAddress'], 16))
+    if args.wstream:
+        try:
+            path = args.wstream
+            args.wstream = ImageStream(open_image(path), args.psize,
+                                       int(hc32xx['PageSize']) * int(hc32xx['PageCount']))
+        except (OSError, ImageError) as e:
+            out.write("%s\n" % e)
+            out.result('image', message=str(e))
+            transport.close()
+            sys.exit(1)
+        args.segments = [(int(hc32xx['StartAddress'], 16), 0, (path == '-' and 'stdin' or path)+' (stream)')]
+    out.write('Device:     %s\n' % args.dev)
+    out.write('Serial:     %s\n' % transport.serial.port)
+    out.write('Boot Baud:  %s\n' % args.baud)
+    out.write('Page Size:  %s\n' % hc32xx['PageSize'])
+    out.write('Page Count: %s\n' % hc32xx['PageCount'])
+    out.write('Flash Size: %s\n' % hc32xx['FlashSize'])
+    out.write('RameCode:   %s\n' % hc32xx['RamCodeBinFile'])
+    out.write('Write Size: %s\n' % args.psize)
+    for addr, size, path in args.segments:
+        out.write(size and 'Image:      0x%08X-0x%08X %s\n' % (addr, addr+size, path)
+                  or 'Image:      0x%08X- %s\n' % (addr, path))
+    out.write('\n%s\n' % hc32xx['IspConnection'])
+    out.set(device=args.dev, port=args.port, adapter=args.adapter, baud=args.baud)
+    out.event('session', device=args.dev, port=args.port, adapter=args.adapter, baud=args.baud,
+              packet=args.psize, images=[['0x%08X' % a, n, p] for a, n, p in args.segments])
+
+    if not args.goboot and args.reboot and not args.loop and not args.plan:
+        ok = transport.reboot()
+        out.write("[REBOOT] %s\n" % (ok and 'ok' or 'error'))
+        transport.close()
+        out.result(None, reboot=ok)
+        sys.exit(0)
+
+    if args.plan:
+        if not enter_bootloader(args, transport, out):
+            transport.close()
+            sys.exit(1)
+        latency = measure_latency(transport, hc32xx['BootloaderBaudrate'])
+        transport.close()
+        if latency is None:
+            out.write("[  PLAN] latency measure error\n")
+            sys.exit(1)
+        profile = load_profile(args.profile)
+        profile.setdefault('adapter|%s' % args.adapter, {})['Latency'] = round(latency, 6)
+        save_profile(args.profile, profile)
+        print_plan(args, hc32xx, ramcode, latency, out)
+        sys.exit(0)
+
+    if args.loop:
+        sys.exit(production_loop(args, hc32xx, ramcode, out, transport))
+
+    if args.watch:
+        sys.exit(watch_loop(args, hc32xx, ramcode, out, transport))
+
+    err = 'boot'
+    if enter_bootloader(args, transport, out):
+        err = program_device(args, transport, hc32xx, ramcode, out)
 
     transport.close()
-    sys.exit(0)
+    record_unit(args, out, err)
+    if args.replay:
+        stat = transport.serial.summary()
+        out.write("[REPLAY] %(writes)d writes, %(mismatch)d mismatched, %(unsent)d/%(unread)d "
+                  "records left, recorded %(recorded).3fs, replayed %(replayed).3fs\n" % stat)
+        out.set(replay=stat)
+    out.result(err)
+    sys.exit(err and 1 or 0)